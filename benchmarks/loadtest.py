@@ -0,0 +1,347 @@
+"""Load test driven by synthetic danmaku.
+
+Feeds a seeded stream of draws, batch draws, 点歌, gifts and plain chat from
+``--users`` users into ``LiveHandler`` at ``--rate`` messages per second
+(0 = as fast as possible). It runs on a SQLite database (in memory by
+default), a stub music service without network calls, and websocket
+senders with ``--clients`` fake clients attached instead of a listening
+socket. Reports throughput, command latency percentiles per kind and the
+latency from submitting a draw to its broadcast reaching a client::
+
+    python -m benchmarks.loadtest --messages 20000 --users 500 --rate 2000
+    python -m benchmarks.loadtest --pipeline --mix draw=50,batch=20,song=20,gift=10
+
+Command latency is measured from the time a message was due, not from when
+it was sent, so a saturated server shows up as latency instead of a lower
+send rate. Draw latency is measured from the last submitted draw of a
+position to the first broadcast containing it.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import random
+import struct
+import time
+import zlib
+from functools import partial
+from types import SimpleNamespace
+
+from canvas import Canvas, Color, Pixel
+from live_handler import DanmakuPipeline, LiveHandler
+from metrics import Metrics
+from music import Playlist
+from sql import SQL
+from user import User
+from websocket_sender import WebsocketSender, DRAW_FRAME_MAGIC, \
+    FRAME_SHORT_POS, _DRAW_FRAME_HEADER
+
+_KINDS = ("draw", "batch", "song", "gift", "chat")
+_CHAT = ["哈哈哈哈哈", "主播好", "awsl", "？？？", "2233", "早上好"]
+
+
+class StubMusicService:
+    """Answers like ``MusicService`` after ``latency`` seconds."""
+
+    def __init__(self, latency=0.02):
+        self._latency = latency
+
+    async def search(self, query):
+        await asyncio.sleep(self._latency)
+        return zlib.crc32(query.encode()), query, "artist", 200000
+
+    async def get_info(self, id):
+        await asyncio.sleep(self._latency)
+        return {'id': id, 'name': str(id), 'artists': ["artist"],
+                "cover_url": ""}
+
+    async def get_play_url(self, id):
+        await asyncio.sleep(self._latency)
+        return f"http://localhost/{id}.mp3"
+
+    async def close(self):
+        pass
+
+
+class LocalSender(WebsocketSender):
+    """WebsocketSender without a listening socket, clients are attached
+    by calling ``_connect`` directly."""
+
+    def _start(self):
+        pass
+
+
+class FakeClient:
+    def __init__(self, on_message=None):
+        self._closed = asyncio.get_event_loop().create_future()
+        self._on_message = on_message
+        self.received = 0
+
+    async def send(self, payload):
+        self.received += 1
+        if self._on_message is not None:
+            self._on_message(payload)
+
+    async def wait_closed(self):
+        await self._closed
+
+    async def close(self):
+        if not self._closed.done():
+            self._closed.set_result(None)
+
+
+class DrawProbe:
+    """Matches broadcast positions with the time their draw was submitted."""
+
+    def __init__(self):
+        self.pending = {}
+        self.latencies = []
+
+    def submitted(self, positions, when):
+        pending = self.pending
+        for pos in positions:
+            pending[pos] = when
+
+    def __call__(self, payload):
+        if isinstance(payload, bytes):
+            positions = self._frame_positions(payload)
+        elif payload.startswith('{"type":"DRAW'):
+            positions = json.loads(payload)["data"]["pos"]
+            if not isinstance(positions, list):
+                positions = [positions]
+        else:
+            return
+        now = time.perf_counter()
+        pending = self.pending
+        for pos in positions:
+            submitted = pending.pop(pos, None)
+            if submitted is not None:
+                self.latencies.append(now - submitted)
+
+    @staticmethod
+    def _frame_positions(payload):
+        if not payload.startswith(DRAW_FRAME_MAGIC):
+            return ()
+        _, _, _, flags, _, count = _DRAW_FRAME_HEADER.unpack_from(payload)
+        code = 'H' if flags & FRAME_SHORT_POS else 'I'
+        return struct.unpack_from('<%d%s' % (count, code), payload,
+                                  _DRAW_FRAME_HEADER.size)
+
+
+def parse_mix(text):
+    mix = dict.fromkeys(_KINDS, 0)
+    for item in text.split(","):
+        kind, _, share = item.partition("=")
+        if kind not in mix:
+            raise argparse.ArgumentTypeError(f"unknown kind {kind}")
+        mix[kind] = float(share)
+    return mix
+
+
+def synthetic_messages(args):
+    """Yields ``(kind, user id, payload, positions)`` tuples."""
+    rng = random.Random(args.seed)
+    kinds = list(args.mix)
+    weights = [args.mix[kind] for kind in kinds]
+    size = args.size
+    for _ in range(args.messages):
+        kind = rng.choices(kinds, weights)[0]
+        uid = rng.randrange(1, args.users + 1)
+        color_id = rng.randrange(1, args.colors + 1)
+        positions = ()
+        if kind == "draw":
+            x, y = rng.randrange(size), rng.randrange(size)
+            text = f"{y + 1}-{x + 1}-{color_id}"
+            positions = (y + x * size,)
+        elif kind == "batch":
+            width = rng.randrange(1, args.batch_size + 1)
+            x, y = rng.randrange(size - width), rng.randrange(size - width)
+            text = f"{y + 1}:{y + width}-{x + 1}:{x + width}-{color_id}"
+            positions = [line + column * size
+                         for column in range(x, x + width)
+                         for line in range(y, y + width)]
+        elif kind == "song":
+            text = f"点歌 song {rng.randrange(args.songs)}"
+        elif kind == "chat":
+            text = rng.choice(_CHAT)
+        else:
+            coin_type = rng.choice(("silver", "gold"))
+            yield kind, uid, dict(user_id=uid, user_name=f"user{uid}",
+                                  gift_name="辣条", gift_count=1,
+                                  coin_type=coin_type,
+                                  coin_count=rng.randrange(1, 1000)), ()
+            continue
+        yield kind, uid, SimpleNamespace(msg=text, uid=uid,
+                                         uname=f"user{uid}"), positions
+
+
+def percentile(values, q):
+    if not values:
+        return float("nan")
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def run(args):
+    SQL().connect(backend="sqlite", path=args.db,
+                  init=[model.__create__ for model in (Pixel, Color, Canvas, User)])
+    Metrics.config(enabled=args.metrics)
+    Canvas.config(col=args.size, row=args.size, cooldown=args.cooldown,
+                  colors=["#%06x" % (i * 0x7f3a1) for i in range(args.colors)])
+    await Canvas.init()
+    User.config()
+    User.start()
+    # enough weight that batch draws are never refused for lack of points
+    await User.upsert_many([User(uid=uid, name=f"user{uid}", weight=10 ** 9)
+                            for uid in range(1, args.users + 1)])
+    Playlist.set_serivce(StubMusicService(args.music_latency))
+    Playlist.add_to_default("default song")
+
+    # same policies as server.py
+    message_sender = LocalSender(0, queue_size=args.queue_size,
+                                 slow_policy="drop")
+    canvas_sender = LocalSender(0, queue_size=args.queue_size)
+    pipeline = DanmakuPipeline(workers=args.workers,
+                               max_pending=args.max_pending)
+    handler = LiveHandler(message_sender, canvas_sender, {"hints": []},
+                          draw_tick=args.draw_tick / 1000, pipeline=pipeline)
+
+    probe = DrawProbe()
+    path = "/?frames=binary" if args.binary else "/"
+    clients = [FakeClient(probe if i == 0 else None)
+               for i in range(args.clients)]
+    loop = asyncio.get_event_loop()
+    connections = [loop.create_task(canvas_sender._connect(client, path))
+                   for client in clients]
+    message_clients = [FakeClient() for _ in range(args.clients)]
+    connections += [loop.create_task(message_sender._connect(client, "/"))
+                    for client in message_clients]
+    await asyncio.sleep(0)
+
+    latencies = {kind: [] for kind in _KINDS}
+    running = set()
+    slots = asyncio.Semaphore(args.concurrency)
+
+    async def timed(kind, job, due):
+        try:
+            await job()
+        except Exception:
+            logging.exception(f"Synthetic {kind} failed.")
+        latencies[kind].append(time.perf_counter() - due)
+
+    async def direct(kind, job, due):
+        try:
+            await timed(kind, job, due)
+        finally:
+            slots.release()
+
+    start = time.perf_counter()
+    for index, (kind, uid, payload, positions) in \
+            enumerate(synthetic_messages(args)):
+        due = start + index / args.rate if args.rate else time.perf_counter()
+        delay = due - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if positions:
+            probe.submitted(positions, due)
+        if kind == "gift":
+            job = partial(handler.receive_gift, **payload)
+        else:
+            job = partial(handler.parse_danmaku, payload)
+        if args.pipeline:
+            # as submit_danmaku does: parsed here, plain chat never queued
+            pipeline_kind = "gift"
+            if kind != "gift":
+                command = handler.parse_command(payload)
+                if command is None:
+                    continue
+                pipeline_kind, job = command
+            pipeline.submit(uid, pipeline_kind, partial(timed, kind, job, due))
+            # let workers run between submissions
+            await asyncio.sleep(0)
+        else:
+            await slots.acquire()
+            task = loop.create_task(direct(kind, job, due))
+            running.add(task)
+            task.add_done_callback(running.discard)
+    submitted = time.perf_counter() - start
+
+    while running:
+        await asyncio.gather(*list(running))
+    await pipeline.close(timeout=60)
+    # let the last coalesced draws and queued frames go out
+    await asyncio.sleep(args.draw_tick / 1000 * 2 + 0.05)
+    elapsed = time.perf_counter() - start
+
+    connected = canvas_sender.client_count(), message_sender.client_count()
+    for client in clients + message_clients:
+        await client.close()
+    await asyncio.gather(*connections, return_exceptions=True)
+    await Canvas.close()
+    await User.close()
+
+    done = sum(len(values) for values in latencies.values())
+    print(f"{args.messages} messages from {args.users} users in {elapsed:.2f}s "
+          f"(submitted in {submitted:.2f}s), {done / elapsed:.0f} commands/s")
+    print(f"{'kind':>8} {'count':>8} {'p50 ms':>10} {'p99 ms':>10} {'max ms':>10}")
+    for kind, values in latencies.items():
+        if not values:
+            continue
+        values.sort()
+        print(f"{kind:>8} {len(values):8d} {percentile(values, 0.5) * 1e3:10.2f}"
+              f" {percentile(values, 0.99) * 1e3:10.2f} {values[-1] * 1e3:10.2f}")
+    draws = sorted(probe.latencies)
+    print(f"draw to broadcast: {len(draws)} positions, "
+          f"p50 {percentile(draws, 0.5) * 1e3:.2f} ms, "
+          f"p99 {percentile(draws, 0.99) * 1e3:.2f} ms, "
+          f"{len(probe.pending)} never broadcast")
+    print(f"canvas frames per client: {sum(c.received for c in clients) / max(1, len(clients)):.0f}, "
+          f"message frames per client: {sum(c.received for c in message_clients) / max(1, len(message_clients)):.0f}, "
+          f"still connected: {connected[0]}/{len(clients)} canvas, "
+          f"{connected[1]}/{len(message_clients)} message")
+    stats = pipeline.stats()
+    if args.pipeline:
+        print(f"pipeline: processed {stats['processed']}, dropped "
+              f"{stats['dropped_full']} full / {stats['dropped_stale']} stale")
+    if args.metrics:
+        print(Metrics.render())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--rate", type=float, default=0,
+                        help="messages per second, 0 = unthrottled")
+    parser.add_argument("--mix", type=parse_mix,
+                        default=parse_mix("draw=60,batch=10,song=10,gift=5,chat=15"))
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--queue-size", type=int, default=256,
+                        help="outbound messages queued per client")
+    parser.add_argument("--binary", action="store_true",
+                        help="canvas clients take binary draw frames")
+    parser.add_argument("--size", type=int, default=100,
+                        help="canvas columns and rows")
+    parser.add_argument("--colors", type=int, default=16)
+    parser.add_argument("--batch-size", type=int, default=5,
+                        help="largest side of a batch draw")
+    parser.add_argument("--songs", type=int, default=200)
+    parser.add_argument("--cooldown", type=float, default=0)
+    parser.add_argument("--draw-tick", type=float, default=50,
+                        help="ms, 0 sends one message per draw")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="submit through DanmakuPipeline")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--max-pending", type=int, default=100000)
+    parser.add_argument("--concurrency", type=int, default=1000,
+                        help="commands in flight without --pipeline")
+    parser.add_argument("--music-latency", type=float, default=0.02)
+    parser.add_argument("--db", default=":memory:")
+    parser.add_argument("--metrics", action="store_true")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+    asyncio.get_event_loop().run_until_complete(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""Message encoding micro-benchmark.
+
+Encodes typical messages of each type with the stdlib and orjson encoders
+(when installed), as cached re-sends, and as binary draw frames, and prints
+the cost and size of each::
+
+    python -m benchmarks.message_encode
+"""
+import argparse
+import random
+import timeit
+
+import websocket_sender
+from websocket_sender import Message, MessageType
+
+
+def sample_messages(col=100, row=100, pixels=500, songs=20):
+    rng = random.Random(1)
+    names = ["用户%d" % i for i in range(50)]
+    colors = {color_id: "#%06x" % rng.randrange(0x1000000)
+              for color_id in range(1, 33)}
+    return {
+        MessageType.DRAW_PIXEL: {
+            "username": names[0], "pos": 1234, "colorid": 5, "version": 99},
+        MessageType.DRAW_MULTIPLE_PIXELS: {
+            "username": names[1], "pos": list(range(200, 300)),
+            "colorid": 7, "version": 199},
+        MessageType.DRAW_PIXELS: {
+            "pos": rng.sample(range(col * row), pixels),
+            "colorid": [rng.randrange(1, 33) for _ in range(pixels)],
+            "username": [rng.choice(names) for _ in range(pixels)],
+            "version": 699},
+        MessageType.TEXT_MESSAGE: {
+            "text": f"{names[2]} 涂色: 12-30-5", "viplevel": 0},
+        MessageType.UPDATE_PLAYLIST: [
+            {"user_name": rng.choice(names), "song_id": 26060065 + i,
+             "song_name": "晴天", "artists": "周杰伦"} for i in range(songs)],
+        MessageType.INIT_CANVAS: {
+            "col_num": col, "row_num": row, "colors": colors,
+            "pixels": [rng.choice([None, rng.randrange(1, 33)])
+                       for _ in range(col * row)],
+            "version": 0, "epoch": 0},
+    }
+
+
+def best(function, number, repeat):
+    return min(timeit.repeat(function, number=number, repeat=repeat)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    encoders = [("json", websocket_sender._json_dumps)]
+    if websocket_sender.orjson is not None:
+        encoders.append(("orjson", websocket_sender._orjson_dumps))
+    else:
+        print("orjson is not installed, skipping it.")
+
+    print(f"{'type':>22} {'encoder':>8} {'fresh':>10} {'cached':>10} {'bytes':>8}")
+    for message_type, data in sample_messages().items():
+        for name, dumps in encoders:
+            Message.set_encoder(dumps)
+            fresh = best(lambda: str(Message(message_type, data)),
+                         args.number, args.repeat)
+            message = Message(message_type, data)
+            size = len(message.encode())
+            cached = best(lambda: str(message), args.number, args.repeat)
+            print(f"{message_type.name:>22} {name:>8} {fresh * 1e6:8.2f}us"
+                  f" {cached * 1e6:8.2f}us {size:8d}")
+        if Message(message_type, data).to_binary() is not None:
+            fresh = best(lambda: Message(message_type, data).to_binary(),
+                         args.number, args.repeat)
+            size = len(Message(message_type, data).to_binary())
+            print(f"{message_type.name:>22} {'binary':>8} {fresh * 1e6:8.2f}us"
+                  f" {'':>10} {size:8d}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""Memory and load time of ORM rows.
+
+Fills an in-memory SQLite ``pixel_history`` table and loads it back as
+dict-based rows (the previous ``Model``), slotted ``Model`` rows and raw
+tuples::
+
+    python -m benchmarks.orm_rows --rows 1000000
+"""
+import argparse
+import asyncio
+import gc
+import time
+import tracemalloc
+
+from orm import Model, IntegerField, TimestampField
+from sql import SQL
+
+
+class HistoryRow(Model):
+    __table__ = "pixel_history"
+
+    id = IntegerField('id', primary_key=True)
+    pos = IntegerField('pos')
+    time = TimestampField('time')
+    color_id = IntegerField('color_id')
+    user_id = IntegerField('user_id')
+
+
+class DictRow(dict):
+    """The dict subclass rows used before slotted models."""
+
+    def __getattr__(self, key):
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(key)
+
+
+async def fill(rows):
+    batch = []
+    for i in range(1, rows + 1):
+        batch.append((i % 250000, '2021-01-01 00:00:00', i % 32, i % 5000, i))
+        if len(batch) == 10000:
+            await HistoryRow.save_many(batch)
+            batch = []
+    if batch:
+        await HistoryRow.save_many(batch)
+
+
+async def load_dict():
+    rs = await HistoryRow.get_all(raw=True)
+    columns = HistoryRow.__columns__
+    return [DictRow(**dict(zip(columns, r))) for r in rs]
+
+
+async def load_slotted():
+    return await HistoryRow.get_all()
+
+
+async def load_raw():
+    return await HistoryRow.get_all(raw=True)
+
+
+async def stream_raw():
+    count = 0
+    async for rows in HistoryRow.iter_all(10000, raw=True):
+        count += len(rows)
+    return count
+
+
+def measure(loop, load):
+    gc.collect()
+    start = time.perf_counter()
+    result = loop.run_until_complete(load())
+    elapsed = time.perf_counter() - start
+    del result
+    gc.collect()
+    tracemalloc.start()
+    result = loop.run_until_complete(load())
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1000000)
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    SQL().connect(backend="sqlite", init=[HistoryRow.__create__])
+    loop.run_until_complete(fill(args.rows))
+
+    for name, load in (("dict rows", load_dict), ("slotted rows", load_slotted),
+                       ("raw tuples", load_raw), ("raw stream", stream_raw)):
+        elapsed, peak = measure(loop, load)
+        print(f"{name:>13}: {elapsed:6.2f} s, peak {peak / 2 ** 20:8.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""Danmaku parser micro-benchmark.
+
+Replays recorded chat through the old ``re.split`` parser and through
+``commands.parse_command``, checks that both agree and prints the cost per
+message. The corpus is one or more live room logs written by server.py
+(``live-room-<date>.log``) or, with ``--plain``, text files with one message
+per line::
+
+    python -m benchmarks.parse_danmaku live-room-*.log
+"""
+import argparse
+import re
+import timeit
+
+from commands import parse_command, DrawCmd, SongCmd, SkipCmd, ValueCmd
+
+# "<asctime>: INFO - <uname> <uid>：<msg>", gift lines have no uid
+_LOG_LINE = re.compile(r'^.*?: INFO - .*? \d+：(.*)$')
+
+_SAMPLE = [
+    "哈哈哈哈哈", "主播好", "12-30-5", "1:5-3：7-2", "点歌 晴天", "切歌", "点数",
+    "awsl", "？？？", "2233", "5-5", "早上好", "点歌", "10-10-10-10",
+]
+
+
+def legacy_parse(text):
+    tokens = re.split('-|—|－|﹣|﹣| ', text)
+    length = len(tokens)
+    if length == 1:
+        if tokens[0] == "切歌":
+            return "skip"
+        elif tokens[0] == "点数":
+            return "value"
+    elif tokens[0] == "点歌":
+        return "song", " ".join(tokens[1:])
+    elif length == 3:
+        try:
+            ranges = [legacy_range(tokens[1]), legacy_range(tokens[0])]
+            x, y = [(min(r), max(r)) for r in ranges]
+            return "draw", x[0] - 1, x[1] - 1, y[0] - 1, y[1] - 1, int(tokens[2])
+        except ValueError:
+            return None
+    return None
+
+
+def legacy_range(x):
+    try:
+        single_num = int(x)
+        return single_num, single_num
+    except ValueError:
+        nums_str = re.split(':|：', x)
+        if len(nums_str) != 2:
+            raise ValueError
+        return int(nums_str[0]), int(nums_str[1])
+
+
+def as_legacy(command):
+    if isinstance(command, SkipCmd):
+        return "skip"
+    if isinstance(command, ValueCmd):
+        return "value"
+    if isinstance(command, SongCmd):
+        return "song", command.query
+    if isinstance(command, DrawCmd):
+        return ("draw", command.x_start, command.x_end, command.y_start,
+                command.y_end, command.color_id)
+    return None
+
+
+def load_corpus(paths, plain):
+    messages = []
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as corpus_file:
+            for line in corpus_file:
+                line = line.rstrip("\n")
+                if plain:
+                    messages.append(line)
+                    continue
+                match = _LOG_LINE.match(line)
+                if match:
+                    messages.append(match.group(1))
+    return messages
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("corpus", nargs="*")
+    parser.add_argument("--plain", action="store_true")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    messages = load_corpus(args.corpus, args.plain) if args.corpus else _SAMPLE * 1000
+    if not messages:
+        print("Empty corpus.")
+        return
+
+    mismatches = [m for m in messages if legacy_parse(m) != as_legacy(parse_command(m))]
+    commands = sum(1 for m in messages if parse_command(m) is not None)
+    print(f"{len(messages)} messages, {commands} commands, {len(mismatches)} mismatches")
+    for message in mismatches[:10]:
+        print(f"  mismatch: {message!r}")
+
+    for name, parse in (("legacy", legacy_parse), ("table", parse_command)):
+        best = min(timeit.repeat(lambda: [parse(m) for m in messages],
+                                 number=1, repeat=args.repeat))
+        print(f"{name:>8}: {best / len(messages) * 1e9:8.0f} ns/message")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """Size bounded LRU cache whose entries expire ``ttl`` seconds after
+    they are stored. ``get_or_load`` runs one loader per key at a time and
+    lets concurrent callers wait for its result.
+
+    Expiry times are wall clock timestamps so that entries can be dumped
+    and loaded again after a restart.
+    """
+
+    def __init__(self, ttl, maxsize=1024, clock=time.time):
+        self._ttl = ttl
+        self._maxsize = maxsize
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._loading = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+        value, expires = entry
+        if expires <= self._clock():
+            del self._entries[key]
+            return default
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key, value, expires=None):
+        if expires is None:
+            expires = self._clock() + self._ttl
+        self._entries[key] = (value, expires)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._maxsize:
+            self._entries.popitem(last=False)
+
+    def pop(self, key):
+        self._entries.pop(key, None)
+
+    async def get_or_load(self, key, loader, cache_if=None):
+        value = self.get(key, self)
+        if value is not self:
+            self.hits += 1
+            return value
+        self.misses += 1
+        task = self._loading.get(key)
+        if task is None:
+            task = asyncio.get_event_loop().create_task(loader())
+            self._loading[key] = task
+            task.add_done_callback(lambda _: self._loading.pop(key, None))
+        # shielded so one cancelled caller does not cancel the others
+        value = await asyncio.shield(task)
+        if cache_if is None or cache_if(value):
+            self.set(key, value)
+        return value
+
+    def dump(self):
+        now = self._clock()
+        return [[key, value, expires]
+                for key, (value, expires) in self._entries.items()
+                if expires > now]
+
+    def load(self, entries):
+        now = self._clock()
+        for key, value, expires in entries:
+            if expires > now:
+                self.set(key, value, expires)
@@ -1,24 +1,145 @@
-from typing import OrderedDict
 from orm import Model, StringField, IntegerField, TimestampField, Time
-from collections import OrderedDict
+from array import array
+from collections import deque
+from itertools import groupby, islice
 import asyncio
 import logging
+import mmap
+import os
+import struct
+import sys
+import time
+import zlib
+from cooldown import Cooldown
+from metrics import Metrics
 from user import User
 from websocket_sender import Message, MessageType
 
+# Binary canvas snapshot:
+#   header  <4sBBHHH  magic, format version, encoding, col, row, palette size
+#   palette <HB + hex  color id, hex length, ascii hex string (per color)
+#   body    raw:  col*row little-endian uint16 color ids (0 = empty)
+#           rle:  repeated <HH (run length, color id)
+SNAPSHOT_MAGIC = b"DDCV"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_RAW = 0
+SNAPSHOT_RLE = 1
+
+_RLE_MAX_RUN = 0xFFFF
+
+_DRAWN = (("result", "drawn"),)
+_REJECTED = (("result", "rejected"),)
+
+
+def _encode_rle(buffer):
+    runs = array('H')
+    for color_id, group in groupby(buffer):
+        run = sum(1 for _ in group)
+        while run > 0:
+            length = min(run, _RLE_MAX_RUN)
+            runs.append(length)
+            runs.append(color_id)
+            run -= length
+    return runs
+
+
+def encode_snapshot(col, row, colors, buffer, encoding=None):
+    body = None
+    if encoding != SNAPSHOT_RAW:
+        body = _encode_rle(buffer)
+        if encoding is None and len(body) >= len(buffer):
+            body = None
+    if body is None:
+        encoding = SNAPSHOT_RAW
+        body = array('H', buffer)
+    else:
+        encoding = SNAPSHOT_RLE
+    if sys.byteorder == 'big':
+        body.byteswap()
+
+    snapshot = bytearray(struct.pack('<4sBBHHH', SNAPSHOT_MAGIC,
+                                     SNAPSHOT_VERSION, encoding,
+                                     col, row, len(colors)))
+    for color_id, hex_value in colors.items():
+        hex_bytes = hex_value.encode('ascii')
+        snapshot += struct.pack('<HB', color_id, len(hex_bytes)) + hex_bytes
+    snapshot += body.tobytes()
+    return bytes(snapshot)
+
+
+# Canvas checkpoint file:
+#   header <4sBHHQI  magic, format version, col, row, last pixel id, crc32
+#   body   col*row little-endian uint16 color ids
+CHECKPOINT_MAGIC = b"DDCK"
+CHECKPOINT_VERSION = 1
+_CHECKPOINT_HEADER = struct.Struct('<4sBHHQI')
+
+
+def write_checkpoint(path, col, row, buffer, last_id):
+    body = array('H', buffer)
+    if sys.byteorder == 'big':
+        body.byteswap()
+    body = body.tobytes()
+    header = _CHECKPOINT_HEADER.pack(CHECKPOINT_MAGIC, CHECKPOINT_VERSION,
+                                     col, row, last_id, zlib.crc32(body))
+    # readers only ever see the old file or the complete new one
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as checkpoint_file:
+        checkpoint_file.write(header)
+        checkpoint_file.write(body)
+        checkpoint_file.flush()
+        os.fsync(checkpoint_file.fileno())
+    os.replace(tmp_path, path)
+
+
+def read_checkpoint(path, col, row):
+    """Returns ``(buffer, last_id)``, or None if there is no usable
+    checkpoint for a ``col`` x ``row`` canvas."""
+    try:
+        with open(path, "rb") as checkpoint_file, \
+                mmap.mmap(checkpoint_file.fileno(), 0,
+                          access=mmap.ACCESS_READ) as data:
+            if len(data) < _CHECKPOINT_HEADER.size:
+                return None
+            magic, version, file_col, file_row, last_id, crc = \
+                _CHECKPOINT_HEADER.unpack_from(data)
+            if magic != CHECKPOINT_MAGIC or version != CHECKPOINT_VERSION \
+                    or (file_col, file_row) != (col, row) \
+                    or len(data) != _CHECKPOINT_HEADER.size + 2 * col * row:
+                logging.warning(f"Ignored checkpoint {path} for another canvas.")
+                return None
+            body = memoryview(data)[_CHECKPOINT_HEADER.size:]
+            try:
+                if zlib.crc32(body) != crc:
+                    logging.warning(f"Ignored corrupt checkpoint {path}.")
+                    return None
+                buffer = array('H')
+                buffer.frombytes(body)
+            finally:
+                body.release()
+    except (FileNotFoundError, ValueError):
+        # ValueError: mmap of an empty file
+        return None
+    if sys.byteorder == 'big':
+        buffer.byteswap()
+    return buffer, last_id
+
 
 class Pixel(Model):
     __table__ = "pixel_history"
 
-    _buffer = OrderedDict()
-    _expire_time = 3
+    _cooldown = Cooldown(3)
     _last_id = None
 
     @classmethod
     async def init(cls):
-        cls._clear_buffer()
+        cls._cooldown.clear()
         await cls._set_last_id()
 
+    @classmethod
+    def config(cls, cooldown, vip_cooldown=None):
+        cls._cooldown = Cooldown(cooldown, vip_cooldown)
+
     @classmethod
     async def _set_last_id(cls):
         ids = await cls._sql.select('SELECT `id` FROM `%s` ORDER BY id DESC LIMIT 1' % (cls.__table__), [])
@@ -29,32 +150,23 @@ class Pixel(Model):
         cls._last_id = last_id
 
     @classmethod
-    def _clear_buffer(cls):
-        cls._buffer = OrderedDict()
+    def allocate(cls, count):
+        if cls._last_id is None:
+            raise RuntimeError("Run Canvas.init() first")
+        first_id = cls._last_id + 1
+        cls._last_id += count
+        return first_id
 
     @classmethod
-    async def _discard(cls):
-        count = 0
-        while len(cls._buffer) > 0:
-            key, pixel = cls._buffer.popitem(last=False)
-            if Time.timestamp(Time.now()) - Time.timestamp(
-                    pixel.time) <= cls._expire_time:
-                cls._buffer[key] = pixel
-                cls._buffer.move_to_end(key, last=False)
-                break
-            count += 1
-        logging.debug(f"Removed {count} items from pixel history buffer.")
-
-    @classmethod
-    async def pixel(cls, user_id, pos, color_id, ignore_interval=False):
-        if user_id in cls._buffer:
-            interval = Time.timestamp(Time.now()) - \
-                Time.timestamp(cls._buffer[user_id].time)
-            if (interval <= cls._expire_time and not ignore_interval):
-                logging.debug(
-                    f"User {user_id} draw too frequently, {cls._expire_time - interval} seconds left.")
-                return None
-        await cls._discard()
+    def cooldown(cls, user_id):
+        return cls._cooldown.remaining(user_id)
+
+    @classmethod
+    def pixel(cls, user_id, pos, color_id, vip_level=0, ignore_interval=False):
+        if not cls._cooldown.hit(user_id, vip_level, force=ignore_interval):
+            logging.debug(
+                f"User {user_id} draw too frequently, {cls._cooldown.remaining(user_id):.1f} seconds left.")
+            return None
         pixel = Pixel(pos=pos,
                       time=Time.now(),
                       color_id=color_id,
@@ -68,16 +180,11 @@ class Pixel(Model):
     user_id = IntegerField('user_id')
 
     def __init__(self, **kw):
-        if Pixel._last_id is None:
-            if "id" not in kw:
-                raise RuntimeError("Run Canvas.init() first")
-        else:
-            Pixel._last_id += 1
-            kw["id"] = Pixel._last_id
+        # rows loaded from the DB keep their id, new pixels get the next one
+        if "id" not in kw:
+            kw["id"] = Pixel.allocate(1)
 
         super(Pixel, self).__init__(**kw)
-        Pixel._buffer[self.user_id] = self
-        logging.debug(f"Added user {self.user_id} to pixel history buffer.")
 
 
 class Color(Model):
@@ -86,9 +193,14 @@ class Color(Model):
     colors = {}
 
     @classmethod
-    async def init(cls):
+    async def init(cls, defaults=None):
         colors = await super().get_all()
-        for color in colors:
+        if not colors and defaults:
+            # an empty local database gets the palette from config.json
+            await cls.save_many(
+                [(hex, color_id) for color_id, hex in enumerate(defaults, 1)])
+            colors = await super().get_all()
+        for color in colors or []:
             cls.colors[color.id] = color.hex
 
     @classmethod
@@ -103,28 +215,350 @@ class Color(Model):
     hex = StringField('hex', length=10)
 
 
+class PixelWriter:
+    """Write-behind queue for drawn pixels.
+
+    Rows are ``(id, pos, time, color_id, user_id)`` tuples. They are written
+    as one multi-row ``pixel_history`` insert and one multi-row ``canvas``
+    upsert per batch, once ``batch_size`` rows are queued or every
+    ``flush_interval`` seconds. ``put`` blocks while ``max_pending`` rows are
+    waiting, so a slow database slows drawing down instead of eating memory.
+    """
+
+    def __init__(self, batch_size=500, flush_interval=1, max_pending=20000,
+                 retries=3):
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._retries = retries
+        self._queue = asyncio.Queue(max_pending)
+        self._full = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task = None
+        # pixel_history rows given up on since start
+        self.dropped = 0
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_event_loop().create_task(self._run())
+
+    async def put(self, row):
+        await self._queue.put(row)
+        if self._queue.qsize() >= self._batch_size:
+            self._full.set()
+
+    async def put_many(self, rows):
+        for row in rows:
+            await self._queue.put(row)
+        if self._queue.qsize() >= self._batch_size:
+            self._full.set()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), self._flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            await self.flush()
+
+    async def flush(self):
+        """Writes every queued row, returns how many of them were dropped."""
+        dropped = 0
+        async with self._lock:
+            while not self._queue.empty():
+                batch = []
+                while len(batch) < self._batch_size and not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                dropped += await self._write(batch)
+        self.dropped += dropped
+        return dropped
+
+    async def _write(self, batch):
+        pixel_args = [(pos, time, color_id, user_id, pixel_id)
+                      for pixel_id, pos, time, color_id, user_id in batch]
+        # only the last write to a position matters for the canvas table
+        latest = {}
+        for pixel_id, pos, _, _, _ in batch:
+            latest[pos] = pixel_id
+        canvas_args = [(pixel_id, pos) for pos, pixel_id in latest.items()]
+        # upsert rather than insert so a retried batch cannot hit duplicate ids
+        if not await self._execute(Pixel, pixel_args):
+            return len(batch)
+        await self._execute(Canvas, canvas_args)
+        logging.debug(f"Flushed {len(batch)} pixels to DB.")
+        return 0
+
+    async def _execute(self, model, args):
+        for attempt in range(self._retries):
+            try:
+                await model.upsert_many(args)
+                return True
+            except Exception:
+                logging.exception(
+                    f"Pixel write failed ({attempt + 1}/{self._retries}).")
+                await asyncio.sleep(2 ** attempt)
+        logging.error(f"Dropped {len(args)} rows after {self._retries} attempts.")
+        return False
+
+    async def close(self):
+        if self._task is not None:
+            # only stop the loop between batches, a cancelled write would
+            # lose rows already taken off the queue
+            async with self._lock:
+                self._task.cancel()
+                try:
+                    await self._task
+                except asyncio.CancelledError:
+                    pass
+            self._task = None
+        await self.flush()
+
+
 class Canvas(Model):
     __table__ = "canvas"
 
     _canvas_row = None
     _canvas_col = None
     _canvas_buffer = None
+    _writer = None
+    _default_colors = None
+    _checkpoint_path = None
+    _checkpoint_interval = 60
+    _checkpoint_verify = False
+    _checkpoint_id = None
+    _checkpoint_task = None
+    # every pixel write bumps the version and is logged in the ring buffer
+    # as (version, pos, color id); the epoch changes on every start
+    _version = 0
+    _epoch = None
+    _changes = deque()
+    _ready = False
+    _tile_size = 16
+    _tiles_per_line = 1
+    _tile_versions = None
 
     @classmethod
-    def config(cls, col, row):
+    def config(cls, col, row, batch_size=500, flush_interval=1,
+               max_pending=20000, cooldown=3, vip_cooldown=None,
+               colors=None, checkpoint_path=None, checkpoint_interval=60,
+               checkpoint_verify=False, tile_size=16, history_size=10000):
         cls._canvas_row = row
         cls._canvas_col = col
-        cls._canvas_buffer = [None]*cls._canvas_col*cls._canvas_row
+        cls._canvas_buffer = array('H', bytes(2 * col * row))
+        cls._version = 0
+        cls._epoch = int(time.time() * 1000)
+        cls._changes = deque(maxlen=history_size)
+        cls._ready = False
+        cls._tile_size = tile_size
+        cls._tiles_per_line = -(-col // tile_size)
+        cls._tile_versions = array('Q', bytes(
+            8 * cls._tiles_per_line * -(-row // tile_size)))
+        cls._writer = PixelWriter(batch_size=batch_size,
+                                  flush_interval=flush_interval,
+                                  max_pending=max_pending)
+        Pixel.config(cooldown, vip_cooldown)
+        cls._default_colors = colors
+        cls._checkpoint_path = checkpoint_path
+        cls._checkpoint_interval = checkpoint_interval
+        cls._checkpoint_verify = checkpoint_verify
+        cls._checkpoint_id = None
 
     @classmethod
     async def init(cls):
-        await Color.init()
-        canvas_pixels = await cls.get_all()
-        if canvas_pixels:
-            for canvas_pixel in canvas_pixels:
-                pixel = await Pixel.find(canvas_pixel.pixel_id)
-                cls._canvas_buffer[canvas_pixel.pos] = pixel.color_id
+        start = time.perf_counter()
+        await Color.init(cls._default_colors)
+        checkpoint = None
+        if cls._checkpoint_path:
+            checkpoint = read_checkpoint(cls._checkpoint_path,
+                                         cls._canvas_col, cls._canvas_row)
+        if checkpoint is None:
+            count = await cls._load()
+            source = "DB"
+        else:
+            cls._canvas_buffer, cls._checkpoint_id = checkpoint
+            count = await cls._replay(cls._checkpoint_id)
+            source = f"checkpoint {cls._checkpoint_id} + history"
+            if cls._checkpoint_verify:
+                await cls._verify()
         await Pixel.init()
+        if cls._checkpoint_id is not None:
+            # never hand out ids the checkpoint already covers
+            Pixel._last_id = max(Pixel._last_id, cls._checkpoint_id)
+        cls._writer.start()
+        if cls._checkpoint_path and cls._checkpoint_task is None:
+            cls._checkpoint_task = asyncio.get_event_loop().create_task(
+                cls._checkpoint_loop())
+        cls._start_epoch()
+        logging.info(
+            f"Canvas hydrated with {count} pixels from {source} in {time.perf_counter() - start:.3f}s.")
+
+    @classmethod
+    async def _load(cls, chunk_size=5000):
+        query = 'SELECT c.`pos`, p.`color_id` FROM `%s` c JOIN `%s` p ON c.`pixel_id` = p.`id`' % (
+            cls.__table__, Pixel.__table__)
+        buffer = cls._canvas_buffer
+        size = len(buffer)
+        count = 0
+        async for rows in cls._sql.iterate(query, [], chunk_size):
+            for pos, color_id in rows:
+                if 0 <= pos < size:
+                    buffer[pos] = color_id
+            count += len(rows)
+        return count
+
+    @classmethod
+    async def _replay(cls, last_id, chunk_size=5000):
+        query = 'SELECT `pos`, `color_id` FROM `%s` WHERE `id` > ? ORDER BY `id`' % (
+            Pixel.__table__)
+        buffer = cls._canvas_buffer
+        size = len(buffer)
+        count = 0
+        async for rows in cls._sql.iterate(query, [last_id], chunk_size):
+            for pos, color_id in rows:
+                if 0 <= pos < size:
+                    buffer[pos] = color_id
+            count += len(rows)
+        return count
+
+    @classmethod
+    async def _verify(cls):
+        expected = cls._canvas_buffer
+        cls._canvas_buffer = array('H', bytes(2 * len(expected)))
+        await cls._load()
+        diff = sum(1 for a, b in zip(expected, cls._canvas_buffer) if a != b)
+        if diff:
+            # the DB is the source of truth, keep what it says
+            logging.warning(
+                f"Checkpoint differs from DB at {diff} positions, using DB.")
+        else:
+            logging.info("Checkpoint matches DB.")
+        return diff
+
+    @classmethod
+    async def checkpoint(cls):
+        """Writes the canvas buffer and the last pixel id it contains to
+        the checkpoint file, if anything was drawn since the last one."""
+        # flushing first keeps the checkpoint from running ahead of the DB
+        await cls._writer.flush()
+        if cls._writer.dropped:
+            # pixel ids past a dropped batch would hide it from the history
+            # replay, keep the last checkpoint that matches the DB instead
+            logging.warning(f"Canvas checkpoint skipped, {cls._writer.dropped} "
+                            f"pixels never reached pixel_history.")
+            return False
+        last_id = Pixel._last_id
+        if last_id is None or last_id == cls._checkpoint_id:
+            return False
+        buffer = array('H', cls._canvas_buffer)
+        await asyncio.get_event_loop().run_in_executor(
+            None, write_checkpoint, cls._checkpoint_path, cls._canvas_col,
+            cls._canvas_row, buffer, last_id)
+        cls._checkpoint_id = last_id
+        logging.debug(f"Canvas checkpoint written at pixel {last_id}.")
+        return True
+
+    @classmethod
+    async def _checkpoint_loop(cls):
+        while True:
+            await asyncio.sleep(cls._checkpoint_interval)
+            try:
+                await cls.checkpoint()
+            except Exception:
+                logging.exception("Canvas checkpoint failed.")
+
+    @classmethod
+    def version(cls):
+        return cls._version
+
+    @classmethod
+    def epoch(cls):
+        return cls._epoch
+
+    @classmethod
+    def ready(cls):
+        return cls._ready
+
+    @classmethod
+    def _start_epoch(cls):
+        # hydration bypasses _set, versions handed out before it are void
+        cls._epoch = max(int(time.time() * 1000), cls._epoch + 1)
+        cls._version += 1
+        cls._changes.clear()
+        cls._ready = True
+
+    @classmethod
+    def _tile(cls, pos):
+        line, offset = divmod(pos, cls._canvas_col)
+        return (line // cls._tile_size) * cls._tiles_per_line + \
+            offset // cls._tile_size
+
+    @classmethod
+    def _set(cls, pos, color_id):
+        # all writes after init go through here to keep versions right
+        cls._canvas_buffer[pos] = color_id
+        cls._version += 1
+        cls._changes.append((cls._version, pos, color_id))
+        cls._tile_versions[cls._tile(pos)] = cls._version
+
+    @classmethod
+    def _set_line(cls, start, width, color_id):
+        cls._canvas_buffer[start:start + width] = \
+            array('H', [color_id]) * width
+        changes = cls._changes
+        tile_versions = cls._tile_versions
+        version = cls._version
+        for pos in range(start, start + width):
+            version += 1
+            changes.append((version, pos, color_id))
+            tile_versions[cls._tile(pos)] = version
+        cls._version = version
+
+    @classmethod
+    def changes(cls, since, epoch=None):
+        """Returns what changed after version ``since`` as ``pos`` and
+        ``colorid`` lists: the logged writes while the ring buffer still
+        reaches back to ``since``, all pixels of the changed tiles after
+        that. Returns None when the client needs a full snapshot."""
+        if not cls._ready or epoch != cls._epoch or since < 0 \
+                or since > cls._version:
+            return None
+        data = {"version": cls._version, "epoch": cls._epoch}
+        changes = cls._changes
+        if since == cls._version:
+            data.update(mode="delta", pos=[], colorid=[])
+        elif changes and changes[0][0] <= since + 1:
+            latest = {}
+            for _, pos, color_id in islice(changes,
+                                           since + 1 - changes[0][0], None):
+                latest.pop(pos, None)
+                latest[pos] = color_id
+            data.update(mode="delta", pos=list(latest),
+                        colorid=list(latest.values()))
+        else:
+            tiles = [tile for tile, version in enumerate(cls._tile_versions)
+                     if version > since]
+            # past half the canvas a snapshot is smaller
+            if 2 * len(tiles) > len(cls._tile_versions):
+                return None
+            positions = []
+            for tile in tiles:
+                positions.extend(cls._tile_positions(tile))
+            buffer = cls._canvas_buffer
+            data.update(mode="tiles", pos=positions,
+                        colorid=[buffer[pos] for pos in positions])
+        return data
+
+    @classmethod
+    def _tile_positions(cls, tile):
+        size = cls._tile_size
+        col = cls._canvas_col
+        lines = len(cls._canvas_buffer) // col
+        tile_line, tile_offset = divmod(tile, cls._tiles_per_line)
+        offset = tile_offset * size
+        width = min(size, col - offset)
+        for line in range(tile_line * size, min((tile_line + 1) * size, lines)):
+            start = line * col + offset
+            yield from range(start, start + width)
 
     @classmethod
     def _get_pos(cls, x, y):
@@ -135,52 +569,109 @@ class Canvas(Model):
         return y + x * cls._canvas_col
 
     @classmethod
-    async def draw(cls, user_id, x, y, color_id, ignore_interval=False):
+    async def draw(cls, user_id, x, y, color_id, vip_level=0,
+                   ignore_interval=False):
+        """Returns ``(pixel, canvas version of the write)``, or
+        ``(None, None)`` if nothing was drawn."""
+        with Metrics.timer("canvas_draw_seconds"):
+            pixel, version = await cls._draw(user_id, x, y, color_id,
+                                             vip_level, ignore_interval)
+        Metrics.inc("canvas_draws_total", _DRAWN if pixel else _REJECTED)
+        return pixel, version
+
+    @classmethod
+    async def _draw(cls, user_id, x, y, color_id, vip_level,
+                    ignore_interval):
         pos = cls._get_pos(x, y)
         if pos is None:
-            return None
+            return None, None
         if Color.get_hex(color_id) is None:
-            return None
+            return None, None
 
-        pixel = await Pixel.pixel(user_id, pos, color_id,
-                                  ignore_interval=ignore_interval)
+        pixel = Pixel.pixel(user_id, pos, color_id, vip_level=vip_level,
+                            ignore_interval=ignore_interval)
         if not pixel:
-            return None
-        canvas_pixel = Canvas(pos=pixel.pos, pixel_id=pixel.id)
-        await pixel.save()
-        await canvas_pixel.save_or_update()
-        cls._canvas_buffer[pixel.pos] = pixel.color_id
+            return None, None
+        cls._set(pixel.pos, pixel.color_id)
+        # read now, later draws may run while put() waits for room
+        version = cls._version
+        await cls._writer.put((pixel.id, pixel.pos, pixel.time,
+                               pixel.color_id, pixel.user_id))
         logging.debug(f"Pixel ({x}, {y}) drawed.")
-        return pixel
+        return pixel, version
 
     @classmethod
-    async def draw_multiple(cls, user_id, x_start, x_end, y_start, y_end, color_id):
+    async def draw_multiple(cls, user_id, x_start, x_end, y_start, y_end,
+                            color_id, vip_level=0):
+        """Returns ``(positions, canvas version after the writes)``, or
+        ``(None, None)`` if nothing was drawn."""
         pos_start = cls._get_pos(x_start, y_start)
         pos_end = cls._get_pos(x_end, y_end)
-        pixels = []
         if pos_start is None or pos_end is None:
-            return None
+            return None, None
+        if x_start > x_end or y_start > y_end:
+            return None, None
+        if Color.get_hex(color_id) is None:
+            return None, None
+
+        Pixel._cooldown.hit(user_id, vip_level, force=True)
+        width = y_end - y_start + 1
+        count = (x_end - x_start + 1) * width
+        first_id = Pixel.allocate(count)
+        now = Time.now()
+        positions = []
         for x in range(x_start, x_end + 1):
-            for y in range(y_start, y_end+1):
-                pixel = await cls.draw(user_id, x, y, color_id,
-                                       ignore_interval=True)
-                if pixel:
-                    pixels.append(pixel)
-        return pixels
+            start = cls._get_pos(x, y_start)
+            cls._set_line(start, width, color_id)
+            positions.extend(range(start, start + width))
+        version = cls._version
+        Metrics.inc("canvas_multiple_pixels_total", value=count)
+        await cls._writer.put_many(
+            [(first_id + i, pos, now, color_id, user_id)
+             for i, pos in enumerate(positions)])
+        logging.debug(f"{count} pixels from ({x_start}, {y_start}) to ({x_end}, {y_end}) drawed.")
+        return positions, version
 
     @classmethod
     def canvas(cls):
         data = {"col_num": cls._canvas_col, "row_num": cls._canvas_row,
-                "colors": Color.colors, "pixels": cls._canvas_buffer}
+                "colors": Color.colors,
+                "pixels": [color_id or None for color_id in cls._canvas_buffer],
+                "version": cls._version, "epoch": cls._epoch}
         return Message(MessageType.INIT_CANVAS, data)
 
+    @classmethod
+    def changes_message(cls, since=None, epoch=None):
+        data = cls.changes(cls._version if since is None else since,
+                           cls._epoch if since is None else epoch)
+        return None if data is None else \
+            Message(MessageType.CANVAS_CHANGES, data)
+
+    @classmethod
+    def snapshot(cls, encoding=None):
+        return encode_snapshot(cls._canvas_col, cls._canvas_row, Color.colors,
+                               cls._canvas_buffer, encoding)
+
+    @classmethod
+    async def close(cls):
+        if cls._checkpoint_task is not None:
+            cls._checkpoint_task.cancel()
+            try:
+                await cls._checkpoint_task
+            except asyncio.CancelledError:
+                pass
+            cls._checkpoint_task = None
+        await cls._writer.close()
+        if cls._checkpoint_path:
+            await cls.checkpoint()
+
     pos = IntegerField('pos', primary_key=True)
     pixel_id = IntegerField('pixel_id')
 
 
 async def draw_pixel(user_id, user_name, x, y, color_id):
     user = await User.user(uid=user_id, name=user_name)
-    result = await Canvas.draw(user.uid, x, y, color_id)
-    if result:
+    pixel, _ = await Canvas.draw(user.uid, x, y, color_id)
+    if pixel:
         user.dots_drawed += 1
         await user.save()
@@ -0,0 +1,96 @@
+import re
+
+_SEPARATOR = re.compile('[-—－﹣ ]')
+_RANGE_SEPARATOR = re.compile('[:：]')
+
+
+class DrawCmd:
+    kind = "draw"
+    __slots__ = ("x_start", "x_end", "y_start", "y_end", "color_id")
+
+    # zero based, inclusive ranges
+    def __init__(self, x_start, x_end, y_start, y_end, color_id):
+        self.x_start = x_start
+        self.x_end = x_end
+        self.y_start = y_start
+        self.y_end = y_end
+        self.color_id = color_id
+
+    @property
+    def pixel_count(self):
+        return (self.x_end - self.x_start + 1) * (self.y_end - self.y_start + 1)
+
+
+class SongCmd:
+    kind = "song"
+    __slots__ = ("query",)
+
+    def __init__(self, query):
+        self.query = query
+
+
+class SkipCmd:
+    kind = "skip"
+    __slots__ = ()
+
+
+class ValueCmd:
+    kind = "value"
+    __slots__ = ()
+
+
+def parse_range(text):
+    try:
+        single_num = int(text)
+        return single_num, single_num
+    except ValueError:
+        nums_str = _RANGE_SEPARATOR.split(text)
+        if len(nums_str) != 2:
+            raise ValueError
+        return int(nums_str[0]), int(nums_str[1])
+
+
+def _parse_draw(tokens):
+    x_1, x_2 = parse_range(tokens[1])
+    y_1, y_2 = parse_range(tokens[0])
+    return DrawCmd(min(x_1, x_2) - 1, max(x_1, x_2) - 1,
+                   min(y_1, y_2) - 1, max(y_1, y_2) - 1,
+                   int(tokens[2]))
+
+
+# single token commands
+_KEYWORDS = {
+    "切歌": SkipCmd,
+    "点数": ValueCmd,
+}
+# commands whose first token is the keyword, the rest is the argument
+_PREFIXED = {
+    "点歌": lambda tokens: SongCmd(" ".join(tokens[1:])),
+}
+_INITIALS = frozenset(keyword[0] for keyword in
+                      list(_KEYWORDS) + list(_PREFIXED)) | {'+'}
+
+
+def parse_command(text):
+    """Returns the command in a danmaku, or None for plain chat."""
+    if not text:
+        return None
+    # draws start with a number, int() also takes a sign and whitespace
+    first = text[0]
+    if not (first in _INITIALS or first.isdigit() or first.isspace()):
+        return None
+
+    tokens = _SEPARATOR.split(text)
+    length = len(tokens)
+    if length == 1:
+        command = _KEYWORDS.get(tokens[0])
+        return command() if command else None
+    prefixed = _PREFIXED.get(tokens[0])
+    if prefixed:
+        return prefixed(tokens)
+    if length == 3:
+        try:
+            return _parse_draw(tokens)
+        except ValueError:
+            return None
+    return None
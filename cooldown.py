@@ -0,0 +1,65 @@
+import bisect
+import time
+from collections import deque
+
+
+class Cooldown:
+    """Per-user cooldown deadlines on the monotonic clock.
+
+    Deadlines are kept in a dict for lookups and in a deque in insertion
+    order for expiry, so each entry is appended and popped exactly once.
+    With VIP intervals the deque is only roughly sorted; a short deadline
+    stuck behind a longer one is dropped a little late, which costs memory
+    for at most the longest interval and never affects ``remaining``.
+    """
+
+    def __init__(self, interval, vip_intervals=None, clock=time.monotonic):
+        self._interval = interval
+        # config.json keys are strings
+        vip_intervals = {int(level): value for level, value in
+                         (vip_intervals or {}).items()}
+        self._vip_levels = sorted(vip_intervals)
+        self._vip_intervals = [vip_intervals[level]
+                               for level in self._vip_levels]
+        self._clock = clock
+        self._deadlines = {}
+        self._expiry = deque()
+
+    def interval(self, vip_level=0):
+        # the highest configured vip level not above the user's level wins
+        index = bisect.bisect_right(self._vip_levels, vip_level)
+        if index == 0:
+            return self._interval
+        return self._vip_intervals[index - 1]
+
+    def remaining(self, user_id):
+        deadline = self._deadlines.get(user_id)
+        if deadline is None:
+            return 0
+        return max(0, deadline - self._clock())
+
+    def hit(self, user_id, vip_level=0, force=False):
+        now = self._clock()
+        self._expire(now)
+        deadline = self._deadlines.get(user_id)
+        if deadline is not None and deadline > now and not force:
+            return False
+        deadline = now + self.interval(vip_level)
+        self._deadlines[user_id] = deadline
+        self._expiry.append((deadline, user_id))
+        return True
+
+    def clear(self):
+        self._deadlines.clear()
+        self._expiry.clear()
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def _expire(self, now):
+        expiry = self._expiry
+        deadlines = self._deadlines
+        while expiry and expiry[0][0] <= now:
+            deadline, user_id = expiry.popleft()
+            if deadlines.get(user_id) == deadline:
+                del deadlines[user_id]
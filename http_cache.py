@@ -0,0 +1,102 @@
+"""Memoized HTTP bodies for polled endpoints.
+
+Each cache key keeps the body of its latest version, plus gzip and brotli
+copies compressed on first request, so a poll costs a dict lookup while the
+version is unchanged. ETags are derived from the version and answered with
+304 when the client already has them.
+"""
+import gzip
+import logging
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class CachedBody:
+    __slots__ = ("version", "etag", "body", "_encoded")
+
+    def __init__(self, version, etag, body):
+        self.version = version
+        self.etag = etag
+        self.body = body
+        self._encoded = {}
+
+    def encoded(self, encoding, level):
+        body = self._encoded.get(encoding)
+        if body is None:
+            if encoding == "br":
+                body = brotli.compress(self.body, quality=level)
+            else:
+                body = gzip.compress(self.body, compresslevel=level, mtime=0)
+            self._encoded[encoding] = body
+        return body
+
+
+class HttpCache:
+    def __init__(self, min_size=512, gzip_level=6, brotli_quality=5):
+        self._entries = {}
+        self._min_size = min_size
+        self._levels = {"gzip": gzip_level, "br": brotli_quality}
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, key, version, build):
+        """Returns the cached body of ``key`` at ``version``, awaiting
+        ``build()`` for the bytes when the version changed."""
+        entry = self._entries.get(key)
+        if entry is not None and entry.version == version:
+            self.hits += 1
+            return entry
+        self.misses += 1
+        body = await build()
+        etag = "%s-%s" % (key, "-".join(str(part) for part in version)
+                          if isinstance(version, tuple) else version)
+        entry = CachedBody(version, etag, body)
+        self._entries[key] = entry
+        logging.debug(f"HTTP cache rebuilt {key} at version {version}.")
+        return entry
+
+    def _encoding(self, accept_encoding, size):
+        if size < self._min_size or not accept_encoding:
+            return None
+        accepted = set()
+        for item in accept_encoding.split(","):
+            name, _, params = item.partition(";")
+            param, _, value = params.partition("=")
+            try:
+                if param.strip() == "q" and float(value) == 0:
+                    continue
+            except ValueError:
+                continue
+            accepted.add(name.strip().lower())
+        if brotli is not None and "br" in accepted:
+            return "br"
+        if "gzip" in accepted:
+            return "gzip"
+        return None
+
+    async def respond(self, request_headers, key, version, build,
+                      headers=None):
+        """Returns ``(status, body, headers)`` for a request with
+        ``request_headers`` for ``key`` at ``version``."""
+        entry = await self.get(key, version, build)
+        encoding = self._encoding(request_headers.get("accept-encoding"),
+                                  len(entry.body))
+        etag = '"%s%s"' % (entry.etag, "-" + encoding if encoding else "")
+        headers = dict(headers or ())
+        headers.update({"ETag": etag, "Vary": "Accept-Encoding",
+                        "Cache-Control": "no-cache"})
+        if_none_match = request_headers.get("if-none-match")
+        if if_none_match and (if_none_match.strip() == "*" or etag in (
+                tag.strip().lstrip("W/") for tag in if_none_match.split(","))):
+            return 304, b"", headers
+        if encoding is None:
+            return 200, entry.body, headers
+        headers["Content-Encoding"] = encoding
+        return 200, entry.encoded(encoding, self._levels[encoding]), headers
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses,
+                "entries": len(self._entries)}
@@ -1,27 +1,18 @@
 import asyncio
+from collections import deque
+from functools import partial
 from music import Playlist
 import blivedm.blivedm as blivedm
-import re
-from websocket_sender import Message, MessageType
+import time
+from commands import parse_command, DrawCmd, SongCmd, SkipCmd, ValueCmd
+from websocket_sender import Message, MessageType, DrawCoalescer
 from user import User
 from canvas import Canvas
+from metrics import Metrics
 
 import logging
 
 
-def get_range_num(x: str):
-    try:
-        single_num = int(x)
-        return single_num, single_num
-    except ValueError:
-        nums_str = re.split(':|：', x)
-        if len(nums_str) != 2:
-            raise ValueError
-        num1 = int(nums_str[0])
-        num2 = int(nums_str[1])
-        return num1, num2
-
-
 class DanmakuClient(blivedm.BLiveClient):
     def __init__(self, room_id, handler, logger):
         super().__init__(room_id)
@@ -31,60 +22,174 @@ class DanmakuClient(blivedm.BLiveClient):
 
     async def _on_receive_danmaku(self, danmaku: blivedm.DanmakuMessage):
         self._logger.info(f'{danmaku.uname} {danmaku.uid}：{danmaku.msg}')
-        await self._handler.parse_danmaku(danmaku)
+        self._handler.submit_danmaku(danmaku)
 
     async def _on_receive_gift(self, gift: blivedm.GiftMessage):
         self._logger.info(
             f'{gift.uname} 赠送{gift.gift_name}x{gift.num} （{gift.coin_type}币x{gift.total_coin}）'
         )
-        await self._handler.receive_gift(user_id=gift.uid,
-                                         user_name=gift.uname,
-                                         gift_name=gift.gift_name,
-                                         gift_count=gift.num,
-                                         coin_type=gift.coin_type,
-                                         coin_count=gift.total_coin)
+        self._handler.submit_gift(user_id=gift.uid,
+                                  user_name=gift.uname,
+                                  gift_name=gift.gift_name,
+                                  gift_count=gift.num,
+                                  coin_type=gift.coin_type,
+                                  coin_count=gift.total_coin)
 
     async def _on_buy_guard(self, message: blivedm.GuardBuyMessage):
         self._logger.info(f'{message.username} 购买{message.gift_name}')
 
 
+class DanmakuPipeline:
+    """Runs danmaku commands and gifts on a pool of workers.
+
+    Jobs of one user run one at a time in arrival order, jobs of different
+    users run concurrently. Once ``max_pending`` jobs are waiting, new jobs
+    are dropped, except gifts. Draw jobs that waited longer than
+    ``max_draw_age`` seconds are dropped instead of run.
+    """
+
+    def __init__(self, workers=8, max_pending=1000, max_draw_age=10):
+        self._worker_count = workers
+        self._max_pending = max_pending
+        self._max_draw_age = max_draw_age
+        self._user_jobs = {}
+        self._ready = asyncio.Queue()
+        self._pending = 0
+        self._workers = []
+        self._processed = 0
+        self._dropped_full = 0
+        self._dropped_stale = 0
+        # kind -> [count, total seconds, max seconds], from receipt to done
+        self._latency = {}
+
+    def start(self):
+        loop = asyncio.get_event_loop()
+        while len(self._workers) < self._worker_count:
+            self._workers.append(loop.create_task(self._work()))
+
+    async def close(self, timeout=5):
+        deadline = time.monotonic() + timeout
+        while self._pending and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def submit(self, user_id, kind, job):
+        if self._pending >= self._max_pending and kind != "gift":
+            self._dropped_full += 1
+            Metrics.inc("danmaku_dropped_total", (("reason", "full"),))
+            logging.warning(f"Danmaku pipeline full, {kind} of user {user_id} dropped.")
+            return False
+        jobs = self._user_jobs.get(user_id)
+        if jobs is None:
+            # a user is in the ready queue at most once, so their jobs never overlap
+            jobs = self._user_jobs[user_id] = deque()
+            self._ready.put_nowait(user_id)
+        jobs.append((kind, time.monotonic(), job))
+        self._pending += 1
+        return True
+
+    async def _work(self):
+        while True:
+            user_id = await self._ready.get()
+            jobs = self._user_jobs[user_id]
+            kind, received, job = jobs.popleft()
+            try:
+                await self._run(kind, received, job)
+            finally:
+                self._pending -= 1
+                if jobs:
+                    self._ready.put_nowait(user_id)
+                else:
+                    del self._user_jobs[user_id]
+
+    async def _run(self, kind, received, job):
+        if kind == "draw" and time.monotonic() - received > self._max_draw_age:
+            self._dropped_stale += 1
+            Metrics.inc("danmaku_dropped_total", (("reason", "stale"),))
+            return
+        try:
+            with Metrics.timer("danmaku_command_seconds", (("kind", kind),)):
+                await job()
+        except Exception:
+            logging.exception(f"Danmaku {kind} failed.")
+        elapsed = time.monotonic() - received
+        latency = self._latency.setdefault(kind, [0, 0, 0])
+        latency[0] += 1
+        latency[1] += elapsed
+        latency[2] = max(latency[2], elapsed)
+        self._processed += 1
+        if Metrics.enabled:
+            Metrics.observe("danmaku_latency_seconds", elapsed,
+                            (("kind", kind),))
+
+    def stats(self):
+        return {"depth": self._pending, "users": len(self._user_jobs),
+                "processed": self._processed,
+                "dropped_full": self._dropped_full,
+                "dropped_stale": self._dropped_stale,
+                "latency": {kind: {"count": count, "avg": total / count,
+                                   "max": longest}
+                            for kind, (count, total, longest)
+                            in self._latency.items()}}
+
+
 class LiveHandler:
-    def __init__(self, message_sender, canvas_sender, init_message):
+    def __init__(self, message_sender, canvas_sender, init_message,
+                 draw_tick=0, pipeline=None):
         self._message_ws = message_sender
         self._canvas_ws = canvas_sender
+        self._pipeline = pipeline or DanmakuPipeline()
+        self._pipeline.start()
+        # draws are merged per tick when draw_tick (seconds) is set
+        self._draws = None
+        if draw_tick:
+            self._draws = DrawCoalescer(canvas_sender, draw_tick)
+        self._handlers = {
+            DrawCmd: self._draw_pixel,
+            SongCmd: self._add_song,
+            SkipCmd: self._skip_song,
+            ValueCmd: self._get_value,
+        }
         self.init_message = init_message
         asyncio.get_event_loop().create_task(Canvas.init())
 
+    def submit_danmaku(self, message: blivedm.DanmakuMessage):
+        command = self.parse_command(message)
+        if command:
+            kind, job = command
+            self._pipeline.submit(message.uid, kind, job)
+
+    def submit_gift(self, **gift):
+        self._pipeline.submit(gift["user_id"], "gift",
+                              partial(self.receive_gift, **gift))
+
+    def pipeline_stats(self):
+        return self._pipeline.stats()
+
+    async def close(self):
+        await self._pipeline.close()
+
     async def parse_danmaku(self, message: blivedm.DanmakuMessage):
-        text = message.msg
-        user_id = message.uid
-        user_name = message.uname
-
-        tokens = re.split('-|—|－|﹣|﹣| ', text)
-        length = len(tokens)
-        if length == 1:
-            if (tokens[0] == "切歌"):
-                await self._skip_song(user_id=user_id, user_name=user_name)
-            elif (tokens[0] == "点数"):
-                await self._get_value(user_id=user_id, user_name=user_name)
-
-        elif (tokens[0] == "点歌"):
-            await self._add_song(user_id=user_id,
-                                 user_name=user_name,
-                                 query=" ".join(tokens[1:]))
-        elif length == 3:
-            try:
-                pixel_count, x, y, color_id = self._parse_draw_op(tokens)
-                await self._draw_pixel(user_id=user_id,
-                                       user_name=user_name,
-                                       pixel_count=pixel_count,
-                                       x_start=x[0]-1,
-                                       x_end=x[1]-1,
-                                       y_start=y[0]-1,
-                                       y_end=y[1]-1,
-                                       color_id=color_id)
-            except ValueError:
-                pass
+        command = self.parse_command(message)
+        if command:
+            kind, job = command
+            with Metrics.timer("danmaku_command_seconds", (("kind", kind),)):
+                await job()
+
+    # returns (kind, job) for commands, None for plain chat
+    def parse_command(self, message: blivedm.DanmakuMessage):
+        command = parse_command(message.msg)
+        if command is None:
+            return None
+        if Metrics.enabled:
+            Metrics.inc("danmaku_commands_total", (("kind", command.kind),))
+        return command.kind, partial(self._handlers[type(command)],
+                                     user_id=message.uid,
+                                     user_name=message.uname,
+                                     command=command)
 
     async def receive_gift(self, user_id, user_name, gift_name, gift_count, coin_type, coin_count):
         user = await User.user(uid=user_id, name=user_name)
@@ -121,30 +226,29 @@ class LiveHandler:
         user.weight += weight
         await user.save()
 
-    def _parse_draw_op(self, tokens):
-        x_1, x_2 = get_range_num(tokens[1])
-        y_1, y_2 = get_range_num(tokens[0])
-        x_start = min(x_1, x_2)
-        x_end = max(x_1, x_2)
-        y_start = min(y_1, y_2)
-        y_end = max(y_1, y_2)
-        color_id = int(tokens[2])
-        pixel_count = (x_end - x_start + 1) * (y_end - y_start + 1)
-        return pixel_count, (x_start, x_end), (y_start, y_end), color_id
-
     # draw a pixel on canvas
-    async def _draw_pixel(self, user_id, user_name, pixel_count,
-                          x_start, x_end, y_start, y_end, color_id):
+    async def _draw_pixel(self, user_id, user_name, command):
+        x_start, x_end = command.x_start, command.x_end
+        y_start, y_end = command.y_start, command.y_end
+        color_id = command.color_id
+        pixel_count = command.pixel_count
         user = await User.user(uid=user_id, name=user_name)
         if pixel_count == 1:
-            pixel = await Canvas.draw(user.uid, x_start, y_start, color_id)
+            pixel, version = await Canvas.draw(user.uid, x_start, y_start,
+                                               color_id,
+                                               vip_level=user.vip_level)
             if pixel:
-                data = {
-                    "username": user.name,
-                    "pos": pixel.pos,
-                    "colorid": pixel.color_id
-                }
-                await self._canvas_ws.send(Message(MessageType.DRAW_PIXEL, data))
+                if self._draws:
+                    self._draws.add(pixel.pos, pixel.color_id, user.name,
+                                    version)
+                else:
+                    data = {
+                        "username": user.name,
+                        "pos": pixel.pos,
+                        "colorid": pixel.color_id,
+                        "version": version
+                    }
+                    await self._canvas_ws.send(Message(MessageType.DRAW_PIXEL, data))
                 user.dots_drawed += 1
                 await self._message_ws.send(
                     Message(MessageType.TEXT_MESSAGE, {
@@ -169,19 +273,26 @@ class LiveHandler:
                         "viplevel": user.vip_level
                     }))
                 return
-            pixels = await Canvas.draw_multiple(user.uid, x_start, x_end,
-                                                y_start, y_end, color_id)
-            data = {
-                "username": user.name,
-                "pos": [pixel.pos for pixel in pixels],
-                "colorid": color_id
-            }
-            user.dots_drawed += len(pixels)
+            positions, version = await Canvas.draw_multiple(
+                user.uid, x_start, x_end, y_start, y_end, color_id,
+                vip_level=user.vip_level)
+            if not positions:
+                return
+            user.dots_drawed += len(positions)
             if user.weight > 0:
-                user.weight -= len(pixels)*tiered_ratio
+                user.weight -= len(positions)*tiered_ratio
                 if user.weight < 0:
                     user.weight = 0
-            await self._canvas_ws.send(Message(MessageType.DRAW_MULTIPLE_PIXELS, data))
+            if self._draws:
+                self._draws.add_many(positions, color_id, user.name, version)
+            else:
+                data = {
+                    "username": user.name,
+                    "pos": positions,
+                    "colorid": color_id,
+                    "version": version
+                }
+                await self._canvas_ws.send(Message(MessageType.DRAW_MULTIPLE_PIXELS, data))
             await self._message_ws.send(
                 Message(MessageType.TEXT_MESSAGE, {
                     "text": f"{user.name} 批量涂色成功，剩余点数: {user.weight}",
@@ -190,10 +301,14 @@ class LiveHandler:
         await user.save()
 
     # skip playing song
-    async def _skip_song(self, user_id, user_name):
+    async def _skip_song(self, user_id, user_name, command=None):
         user = await User.user(uid=user_id, name=user_name)
-        if Playlist.playing().user_id == 0 or user_id == Playlist.playing().user_id:
-            await Playlist.skip()
+        playing = Playlist.playing()
+        if playing is None:
+            return
+        if playing.user_id == 0 or user_id == playing.user_id:
+            if not await Playlist.skip(playing):
+                return
             await self._message_ws.send(await Playlist.playlist())
             await self._message_ws.send(
                 Message(MessageType.TEXT_MESSAGE, {
@@ -201,8 +316,8 @@ class LiveHandler:
                     "viplevel": user.vip_level
                 }))
 
-    async def _add_song(self, user_id, user_name, query):
-        query = query.strip()
+    async def _add_song(self, user_id, user_name, command):
+        query = command.query.strip()
         if query == "":
             return
         user = await User.user(uid=user_id, name=user_name)
@@ -218,7 +333,7 @@ class LiveHandler:
                     "viplevel": user.vip_level
                 }))
 
-    async def _get_value(self, user_id, user_name):
+    async def _get_value(self, user_id, user_name, command=None):
         user = await User.user(uid=user_id, name=user_name)
         await self._message_ws.send(
             Message(MessageType.TEXT_MESSAGE, {
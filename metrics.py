@@ -0,0 +1,176 @@
+"""In-process counters, latency histograms and gauges, rendered in the
+Prometheus text format.
+
+Series are named by a metric name and a tuple of ``(label, value)`` pairs.
+While metrics are disabled ``inc``, ``observe`` and ``timer`` return at
+once, and ``timer`` hands out one shared no-op context manager.
+"""
+import time
+from bisect import bisect_left
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # one count per bound plus +Inf, not cumulative
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class _Timer:
+    __slots__ = ("_histogram", "_start")
+
+    def __init__(self, histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._histogram.observe(time.perf_counter() - self._start)
+        return False
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+def _series(name, labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return name
+    return "%s{%s}" % (name, ",".join(
+        '%s="%s"' % (key, _escape(value)) for key, value in pairs))
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics:
+    enabled = False
+    _buckets = DEFAULT_BUCKETS
+    # name -> {labels: value}
+    _counters = {}
+    # name -> {labels: Histogram}
+    _histograms = {}
+    # name -> function returning a number or {labels: number}
+    _gauges = {}
+    _help = {}
+
+    @classmethod
+    def config(cls, enabled=False, buckets=None):
+        cls.enabled = enabled
+        if buckets:
+            cls._buckets = tuple(sorted(buckets))
+
+    @classmethod
+    def describe(cls, name, help_text):
+        cls._help[name] = help_text
+
+    @classmethod
+    def inc(cls, name, labels=(), value=1):
+        if not cls.enabled:
+            return
+        series = cls._counters.get(name)
+        if series is None:
+            series = cls._counters[name] = {}
+        series[labels] = series.get(labels, 0) + value
+
+    @classmethod
+    def _histogram(cls, name, labels):
+        series = cls._histograms.get(name)
+        if series is None:
+            series = cls._histograms[name] = {}
+        histogram = series.get(labels)
+        if histogram is None:
+            histogram = series[labels] = Histogram(cls._buckets)
+        return histogram
+
+    @classmethod
+    def observe(cls, name, seconds, labels=()):
+        if not cls.enabled:
+            return
+        cls._histogram(name, labels).observe(seconds)
+
+    @classmethod
+    def timer(cls, name, labels=()):
+        """Context manager observing the seconds spent in its block."""
+        if not cls.enabled:
+            return _NULL_TIMER
+        return _Timer(cls._histogram(name, labels))
+
+    @classmethod
+    def gauge(cls, name, function, help_text=None):
+        """Registers a gauge read when metrics are rendered."""
+        cls._gauges[name] = function
+        if help_text:
+            cls._help[name] = help_text
+
+    @classmethod
+    def reset(cls):
+        cls._counters = {}
+        cls._histograms = {}
+
+    @classmethod
+    def render(cls):
+        lines = []
+
+        def header(name, kind):
+            if name in cls._help:
+                lines.append(f"# HELP {name} {cls._help[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        for name, function in sorted(cls._gauges.items()):
+            value = function()
+            header(name, "gauge")
+            if isinstance(value, dict):
+                for labels, number in value.items():
+                    lines.append(f"{_series(name, labels)} {_number(number)}")
+            else:
+                lines.append(f"{name} {_number(value)}")
+        for name, series in sorted(cls._counters.items()):
+            header(name, "counter")
+            for labels, value in series.items():
+                lines.append(f"{_series(name, labels)} {_number(value)}")
+        for name, series in sorted(cls._histograms.items()):
+            header(name, "histogram")
+            for labels, histogram in series.items():
+                cumulative = 0
+                for bound, count in zip(histogram.bounds + (float("inf"),),
+                                        histogram.counts):
+                    cumulative += count
+                    lines.append("%s %d" % (_series(
+                        name + "_bucket", labels, (("le", _number(bound)),)),
+                        cumulative))
+                lines.append(f"{_series(name + '_sum', labels)} {_number(histogram.sum)}")
+                lines.append(f"{_series(name + '_count', labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
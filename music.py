@@ -1,8 +1,15 @@
+import asyncio
+import heapq
+import itertools
 import json
 import aiohttp
 import logging
 import random
+import os
+import time
 
+from cache import TTLCache
+from metrics import Metrics
 from websocket_sender import Message, MessageType
 
 
@@ -15,29 +22,131 @@ class NetworkError(Exception):
 
 
 class MusicService:
-    def __init__(self, port, ip='localhost', cookie=None):
+    def __init__(self, port, ip='localhost', cookie=None, timeout=10,
+                 retries=2, backoff=0.5, limit_per_host=10,
+                 search_ttl=86400, info_ttl=604800, url_ttl=600,
+                 cache_size=1000, cache_file=None):
         self._port = port
         self._ip = ip
         self._payload = {}
         if cookie is not None:
             self._payload["cookie"] = cookie
         self.base_url = f"http://{ip}:{port}"
+        self._timeout = aiohttp.ClientTimeout(total=timeout)
+        self._retries = retries
+        self._backoff = backoff
+        self._limit_per_host = limit_per_host
+        self._session = None
+        # path -> [calls, errors, total seconds, max seconds]
+        self._latency = {}
+        self._caches = {
+            "search": TTLCache(search_ttl, cache_size),
+            "info": TTLCache(info_ttl, cache_size),
+            "url": TTLCache(url_ttl, cache_size),
+        }
+        self._cache_file = cache_file
+        self._load_caches()
+
+    def _load_caches(self):
+        if not self._cache_file or not os.path.exists(self._cache_file):
+            return
+        try:
+            with open(self._cache_file, "r") as cache_file:
+                entries = json.load(cache_file)
+            for name, cache in self._caches.items():
+                cache.load(entries.get(name, []))
+        except (OSError, ValueError):
+            logging.warning(f"Music cache {self._cache_file} not loaded.")
+
+    def _save_caches(self):
+        if not self._cache_file:
+            return
+        entries = {name: cache.dump() for name, cache in self._caches.items()}
+        tmp_file = self._cache_file + ".tmp"
+        try:
+            with open(tmp_file, "w") as cache_file:
+                json.dump(entries, cache_file)
+            os.replace(tmp_file, self._cache_file)
+        except OSError:
+            logging.warning(f"Music cache {self._cache_file} not saved.")
+
+    def cache_stats(self):
+        return {name: {"hits": cache.hits, "misses": cache.misses,
+                       "size": len(cache)}
+                for name, cache in self._caches.items()}
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit_per_host=self._limit_per_host, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(connector=connector,
+                                                  timeout=self._timeout)
+        return self._session
+
+    async def close(self):
+        self._save_caches()
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    def stats(self):
+        return {path: {"calls": calls, "errors": errors,
+                       "avg": total / calls, "max": longest}
+                for path, (calls, errors, total, longest)
+                in self._latency.items()}
+
+    def _record(self, path, elapsed, failed):
+        latency = self._latency.setdefault(path, [0, 0, 0, 0])
+        latency[0] += 1
+        latency[1] += failed
+        latency[2] += elapsed
+        latency[3] = max(latency[3], elapsed)
+        if Metrics.enabled:
+            labels = (("path", path),)
+            Metrics.observe("music_request_seconds", elapsed, labels)
+            if failed:
+                Metrics.inc("music_request_errors_total", labels)
 
     async def _get(self, path, payload):
         payload.update(self._payload)
         logging.debug(f"Getting {path}, payload: {payload}")
-        async with aiohttp.ClientSession() as session:
-            async with session.get(self.base_url + path,
-                                   params=payload) as response:
-                if response.status != 200:
-                    logging.warning(
-                        f"Music service not avaliable, code:{response.status}."
-                    )
-                    raise NetworkError
-                html = await response.text()
-        return html
+        start = time.perf_counter()
+        failed = True
+        try:
+            for attempt in range(self._retries + 1):
+                try:
+                    html = await self._request(path, payload)
+                    failed = False
+                    return html
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    if attempt == self._retries:
+                        logging.warning(f"Music service not avaliable: {e!r}.")
+                        raise NetworkError from e
+                    await asyncio.sleep(self._backoff * 2 ** attempt)
+        finally:
+            self._record(path, time.perf_counter() - start, failed)
+
+    async def _request(self, path, payload):
+        async with self._get_session().get(self.base_url + path,
+                                           params=payload) as response:
+            if response.status >= 500:
+                raise aiohttp.ClientResponseError(
+                    response.request_info, response.history,
+                    status=response.status)
+            if response.status != 200:
+                logging.warning(
+                    f"Music service not avaliable, code:{response.status}."
+                )
+                raise NetworkError
+            return await response.text()
 
     async def search(self, query):
+        key = " ".join(query.lower().split())
+        result = await self._caches["search"].get_or_load(
+            key, lambda: self._search(query))
+        return tuple(result)
+
+    async def _search(self, query):
         path = "/search"
         payload = {'keywords': query}
 
@@ -52,6 +161,10 @@ class MusicService:
         return music_id, title, artists, duration
 
     async def get_info(self, id):
+        return await self._caches["info"].get_or_load(
+            str(id), lambda: self._get_info(id))
+
+    async def _get_info(self, id):
         path = "/song/detail"
         payload = {'ids': id}
         result_raw = await self._get(path, payload)
@@ -64,6 +177,12 @@ class MusicService:
         return {'id': id, 'name': name, 'artists': artists, "cover_url": cover}
 
     async def get_play_url(self, id):
+        # unplayable songs are not cached, they may become available
+        return await self._caches["url"].get_or_load(
+            str(id), lambda: self._get_play_url(id),
+            cache_if=lambda url: url is not None)
+
+    async def _get_play_url(self, id):
         path = "/song/url"
         payload = {'id': id, 'br':192000}
         result_raw = await self._get(path, payload)
@@ -91,28 +210,152 @@ class Song:
         }
 
 
+class SongQueue:
+    """Song order of the playlist.
+
+    The playing song is pinned at the head. Behind it come each user's
+    first queued song, highest weight first, then users' extra songs in
+    arrival order. Songs wait in a heap keyed by (tier, -weight, arrival),
+    removals are lazy, and a per-user index answers quota checks.
+    """
+
+    def __init__(self):
+        self._head = None
+        self._heap = []
+        self._entries = {}
+        self._by_user = {}
+        self._seq = itertools.count()
+        self._ordered = None
+        self.version = 0
+
+    def __len__(self):
+        return (self._head is not None) + len(self._entries)
+
+    def __iter__(self):
+        return iter(self.ordered())
+
+    def __contains__(self, song):
+        return song is self._head or song in self._entries
+
+    def head(self):
+        return self._head
+
+    def count(self, user_id):
+        return len(self._by_user.get(user_id, ()))
+
+    def push(self, song):
+        weighted = self.count(song.user_id) == 0
+        self._by_user.setdefault(song.user_id, set()).add(song)
+        if self._head is None:
+            self._head = song
+        else:
+            entry = [0 if weighted else 1, -song.weight if weighted else 0,
+                     next(self._seq), song]
+            self._entries[song] = entry
+            heapq.heappush(self._heap, entry)
+        self._changed()
+
+    def pop(self):
+        song = self._head
+        if song is None:
+            return None
+        self._forget(song)
+        self._head = None
+        while self._heap:
+            next_song = heapq.heappop(self._heap)[-1]
+            if next_song is not None:
+                del self._entries[next_song]
+                self._head = next_song
+                break
+        self._changed()
+        return song
+
+    def remove(self, song):
+        if song is self._head:
+            self.pop()
+            return
+        entry = self._entries.pop(song)
+        entry[-1] = None
+        self._forget(song)
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            self._heap = [entry for entry in self._heap if entry[-1] is not None]
+            heapq.heapify(self._heap)
+        self._changed()
+
+    def remove_user(self, user_id):
+        songs = [song for song in self._by_user.get(user_id, ())
+                 if song is not self._head]
+        for song in songs:
+            self.remove(song)
+        return songs
+
+    def peek(self, count):
+        songs = [] if self._head is None else [self._head]
+        if count > len(songs):
+            songs += [entry[-1] for entry in heapq.nsmallest(
+                count - len(songs), self._entries.values())]
+        return songs
+
+    def ordered(self):
+        if self._ordered is None:
+            self._ordered = self.peek(len(self))
+        return self._ordered
+
+    def _forget(self, song):
+        songs = self._by_user[song.user_id]
+        songs.discard(song)
+        if not songs:
+            del self._by_user[song.user_id]
+
+    def _changed(self):
+        self._ordered = None
+        self.version += 1
+
+
 class Playlist:
     _service = None
-    _playlist = []
-    _user_song_count = {}
+    _playlist = SongQueue()
     _limit_per_user = 3
     _total_limit = 100
 
     _default_playlist = []
     _last_random_index = None
     _random_song = None
+    _random_version = 0
+    _skip_lock = None
+
+    # song -> (info, play_url, resolved at) for the next songs to play
+    _prefetched = {}
+    _prefetch_count = 3
+    _prefetch_ttl = 300
+    _prefetch_task = None
+    _prefetch_again = False
+    _on_change = None
 
     @classmethod
     def set_serivce(cls, music_service):
         cls._service = music_service
 
+    @classmethod
+    def set_on_change(cls, on_change):
+        cls._on_change = on_change
+
+    @classmethod
+    def config_limits(cls, total_limit=100, limit_per_user=3):
+        cls._total_limit = total_limit
+        cls._limit_per_user = limit_per_user
+
+    @classmethod
+    def config_prefetch(cls, count=3, ttl=300):
+        cls._prefetch_count = count
+        cls._prefetch_ttl = ttl
+
     @classmethod
     async def add(cls, user, query):
         if len(cls._playlist) >= cls._total_limit:
             logging.warning(f"{user.name} add song failed: songs reached total limit.")
             return None
-        if user.uid in cls._user_song_count and cls._user_song_count[
-                user.uid] >= cls._limit_per_user:
+        if cls._playlist.count(user.uid) >= cls._limit_per_user:
             logging.warning(f"{user.name} add song failed: user reached limit.")
             return None
         try:
@@ -126,6 +369,11 @@ class Playlist:
         if duration > 600000:
             logging.warning(f"{user.name} add song failed: too long")
             return None
+        # other adds may have run during the search
+        if len(cls._playlist) >= cls._total_limit or \
+                cls._playlist.count(user.uid) >= cls._limit_per_user:
+            logging.warning(f"{user.name} add song failed: limit reached during search.")
+            return None
 
         weight = user.weight
 
@@ -135,23 +383,20 @@ class Playlist:
                     song_name=song_name,
                     artists=artists,
                     weight=weight)
-        if user.uid in cls._user_song_count:
-            cls._user_song_count[user.uid] += 1
-            cls._playlist.append(song)
-        else:
-            cls._user_song_count[user.uid] = 1
-            if len(cls._playlist) == 0 or weight <= cls._playlist[-1].weight:
-                cls._playlist.append(song)
-            else:
-                insert_index = 1
-                for insert_index in range(1, len(cls._playlist)):
-                    if (cls._playlist[insert_index].weight >= weight):
-                        continue
-                    break
-                cls._playlist.insert(insert_index, song)
-        logging.debug(f"Song {song.song_id} added to playlist, user {user.name} ordered {cls._user_song_count[user.uid]} songs.")
+        cls._playlist.push(song)
+        logging.debug(f"Song {song.song_id} added to playlist, user {user.name} ordered {cls._playlist.count(user.uid)} songs.")
+        cls._schedule_prefetch()
         return song
         
+    @classmethod
+    def remove_user_songs(cls, user_id):
+        songs = cls._playlist.remove_user(user_id)
+        for song in songs:
+            cls._prefetched.pop(song, None)
+        if songs:
+            cls._schedule_prefetch()
+        return songs
+
     @classmethod
     def default_palylist(cls):
         return cls._default_playlist
@@ -174,7 +419,7 @@ class Playlist:
                 break
         query = cls._default_playlist[random_index]
         try:
-            song_id, song_name, artists = await cls._service.search(query)
+            song_id, song_name, artists, _ = await cls._service.search(query)
         except EmptyError:
             logging.warning(f"Default song play failed: query {query} not found")
             return None
@@ -187,12 +432,19 @@ class Playlist:
                     song_name=song_name,
                     artists=artists,
                     weight=0)
+        cls._random_version += 1
+        cls._schedule_prefetch()
+
+    @classmethod
+    def version(cls):
+        """Changes whenever ``playlist()`` would return something else."""
+        return cls._playlist.version, cls._random_version
 
     @classmethod
     def playing(cls):
         if len(cls._playlist) == 0:
             return cls._random_song
-        return cls._playlist[0]
+        return cls._playlist.head()
 
     @classmethod
     async def playlist(cls):
@@ -205,26 +457,98 @@ class Playlist:
 
     @classmethod
     async def play(cls):
-        if len(cls._playlist) == 0:
-            song = cls._random_song
+        song = cls.playing()
+        prefetched = cls._prefetched.get(song)
+        if prefetched and time.monotonic() - prefetched[2] <= cls._prefetch_ttl:
+            info, play_url, _ = prefetched
         else:
-            song = cls._playlist[0]
-        first_id = song.song_id
-        info = await cls._service.get_info(first_id)
-        play_url = await cls._service.get_play_url(first_id)
+            info, play_url = await cls._resolve(song)
         succeed = not play_url is None
         logging.debug(f"Song {song.song_name} playing.")
         return succeed, Message(MessageType.PLAY_SONG, {"info": info, "play_url": play_url, "user_name": song.user_name})
 
     @classmethod
-    async def skip(cls):
-        if len(cls._playlist) != 0:
-            song = cls._playlist.pop(0)
-            cls._user_song_count[song.user_id] -= 1
-            if cls._user_song_count[song.user_id] <= 0:
-                del cls._user_song_count[song.user_id]
+    async def skip(cls, song=None):
+        """Skips the playing song, or only ``song`` if it is still the
+        one playing. Returns whether a song was skipped."""
+        # concurrent skips must not skip the song that replaced theirs
+        if cls._skip_lock is None:
+            cls._skip_lock = asyncio.Lock()
+        async with cls._skip_lock:
+            if song is not None and cls.playing() is not song:
+                return False
+            if len(cls._playlist) != 0:
+                cls._remove(cls._playlist.head())
 
-        if len(cls._playlist) == 0:
-            await cls.new_random_song()
+            if len(cls._playlist) == 0:
+                await cls.new_random_song()
+            cls._schedule_prefetch()
         logging.debug(f"Song skipped.")
         return True
+
+    @classmethod
+    def _remove(cls, song):
+        cls._playlist.remove(song)
+        cls._prefetched.pop(song, None)
+
+    @classmethod
+    async def _resolve(cls, song):
+        info = await cls._service.get_info(song.song_id)
+        play_url = await cls._service.get_play_url(song.song_id)
+        return info, play_url
+
+    @classmethod
+    def _schedule_prefetch(cls):
+        if cls._prefetch_task is None or cls._prefetch_task.done():
+            cls._prefetch_task = asyncio.get_event_loop().create_task(
+                cls._prefetch())
+        else:
+            cls._prefetch_again = True
+
+    @classmethod
+    async def _prefetch(cls):
+        # runs again if the queue changed while songs were being resolved
+        cls._prefetch_again = True
+        rounds = 0
+        while cls._prefetch_again and rounds < 5:
+            cls._prefetch_again = False
+            rounds += 1
+            try:
+                await cls._prefetch_upcoming()
+            except Exception:
+                logging.exception("Song prefetch failed.")
+
+    @classmethod
+    async def _prefetch_upcoming(cls):
+        upcoming = cls._playlist.peek(cls._prefetch_count + 1)
+        if cls._random_song is not None:
+            upcoming.append(cls._random_song)
+        for song in list(cls._prefetched):
+            if song not in upcoming:
+                del cls._prefetched[song]
+
+        changed = False
+        random_unplayable = False
+        now = time.monotonic()
+        for song in upcoming:
+            prefetched = cls._prefetched.get(song)
+            if prefetched and now - prefetched[2] <= cls._prefetch_ttl:
+                continue
+            try:
+                info, play_url = await cls._resolve(song)
+            except (NetworkError, LookupError, ValueError):
+                logging.warning(f"Prefetch of song {song.song_id} failed.")
+                continue
+            if play_url is not None:
+                cls._prefetched[song] = (info, play_url, time.monotonic())
+            elif song is cls._random_song:
+                logging.warning(f"Default song {song.song_id} not playable.")
+                random_unplayable = True
+            elif song in cls._playlist and song is not cls._playlist.head():
+                logging.warning(f"Song {song.song_id} not playable, removed from playlist.")
+                cls._remove(song)
+                changed = True
+        if random_unplayable:
+            await cls.new_random_song()
+        if changed and cls._on_change is not None:
+            await cls._on_change()
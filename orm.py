@@ -111,32 +111,57 @@ class ModelMetaclass(type):
                 table_name, ', '.join(escaped_fields), primary_key, ",".join([
                     "?" for _ in range(len(escaped_fields) + 1)
                 ]), '=?, '.join(escaped_fields) + '=?')
+        attrs[
+            '__upsert__'] = "INSERT INTO `%s` (%s, `%s`) VALUES (%s) ON DUPLICATE KEY UPDATE %s" % (
+                table_name, ', '.join(escaped_fields), primary_key, ",".join([
+                    "?" for _ in range(len(escaped_fields) + 1)
+                ]), ', '.join(map(lambda f: '%s=VALUES(%s)' % (f, f),
+                                  escaped_fields)))
+        attrs['__create__'] = 'CREATE TABLE IF NOT EXISTS `%s` (%s)' % (
+            table_name, ', '.join(
+                ['`%s` %s PRIMARY KEY' % (mappings[primary_key].name,
+                                          mappings[primary_key].column_type)] +
+                ['`%s` %s' % (field.name, field.column_type)
+                 for key, field in mappings.items() if key != primary_key]))
         attrs['__delete__'] = 'delete from `%s` where `%s`=?' % (table_name,
                                                                  primary_key)
-        return type.__new__(cls, name, bases, attrs)
+        # rows are slotted objects, columns in __select__ order
+        columns = [primary_key] + [key for key in mappings
+                                   if key != primary_key]
+        attrs['__columns__'] = columns
+        attrs['__slots__'] = tuple(columns)
+        model = type.__new__(cls, name, bases, attrs)
+        model.__setters__ = [model.__dict__[key].__set__ for key in columns]
+        model.__defaults__ = [mappings[key].default for key in columns]
+        return model
 
 
-class Model(dict, metaclass=ModelMetaclass):
+class Model(metaclass=ModelMetaclass):
+    __slots__ = ()
     _sql = SQL()
+    # bulk statements are split to stay below MySQL's max_allowed_packet
+    _max_packet = 1 << 20
+    _max_rows = 1000
 
     def __init__(self, **kw):
-        super(Model, self).__init__(**kw)
+        for key, setter, default in zip(self.__columns__, self.__setters__,
+                                        self.__defaults__):
+            setter(self, kw.pop(key, default))
+        if kw:
+            raise TypeError('%s has no fields %s' % (
+                self.__class__.__name__, ', '.join(kw)))
 
-    def __getattr__(self, key):
-        try:
-            value = self[key]
-        except KeyError:
-            field = self.__mappings__[key]
-            if field.default is not None:
-                value = field.default
-                setattr(self, key, value)
-            else:
-                raise AttributeError(r"'Model' object has no attribute '%s'" %
-                                     key)
-        return value
-
-    def __setattr__(self, key, value):
-        self[key] = value
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, ', '.join(
+            '%s=%r' % (key, getattr(self, key)) for key in self.__columns__))
+
+    @classmethod
+    def from_row(cls, row):
+        ' build an object from a row in __select__ column order. '
+        obj = cls.__new__(cls)
+        for setter, value in zip(cls.__setters__, row):
+            setter(obj, value)
+        return obj
 
     def get_value(self, key):
         return getattr(self, key, None)
@@ -149,19 +174,104 @@ class Model(dict, metaclass=ModelMetaclass):
             [primary_key], 1)
         if len(rs) == 0:
             return None
-        return cls(**dict(zip(cls.__mappings__.keys(), rs[0])))
+        return cls.from_row(rs[0])
 
     @classmethod
-    async def get_all(cls):
+    async def get_all(cls, raw=False):
         rs = await cls._sql.select('%s' % (cls.__select__), [])
         if len(rs) == 0:
             return None
-        return [cls(**dict(zip(cls.__mappings__.keys(), r))) for r in rs]
+        if raw:
+            return rs
+        from_row = cls.from_row
+        return [from_row(r) for r in rs]
 
-    async def save(self):
+    @classmethod
+    async def iter_all(cls, size=1000, raw=False):
+        ' stream all objects, or raw tuples, in lists of at most size. '
+        async for rows in cls.iter_where(None, None, size, raw):
+            yield rows
+
+    @classmethod
+    async def iter_where(cls, where, args=None, size=1000, raw=False):
+        ' stream objects matching a where clause, e.g. "`id` > ? order by `id`". '
+        query = cls.__select__
+        if where:
+            query = '%s where %s' % (query, where)
+        from_row = cls.from_row
+        chunks = cls._sql.iterate(query, args or [], size)
+        try:
+            async for rows in chunks:
+                yield rows if raw else [from_row(r) for r in rows]
+        finally:
+            await chunks.aclose()
+
+    @classmethod
+    async def find_many(cls, keys):
+        ' find objects by a list of primary keys. '
+        keys = list(keys)
+        found = []
+        for start in range(0, len(keys), cls._max_rows):
+            chunk = keys[start:start + cls._max_rows]
+            rs = await cls._sql.select(
+                '%s where `%s` in (%s)' % (cls.__select__, cls.__primary_key__,
+                                           ','.join(['?'] * len(chunk))),
+                chunk)
+            found += [cls.from_row(r) for r in rs]
+        return found
+
+    @classmethod
+    async def save_many(cls, rows):
+        ' insert models, or tuples in insert column order. '
+        return await cls._execute_many(
+            cls.__insert__, [row._insert_args() if isinstance(row, Model)
+                             else row for row in rows])
+
+    @classmethod
+    async def upsert_many(cls, rows):
+        ' insert or update models, or tuples of fields then primary key. '
+        return await cls._execute_many(
+            cls.__upsert__, [row._upsert_args() if isinstance(row, Model)
+                             else row for row in rows])
+
+    @classmethod
+    async def _execute_many(cls, query, args_list):
+        affected = 0
+        for chunk in cls._chunks(args_list):
+            affected += await cls._sql.executemany(query, chunk)
+        logging.debug('Bulk write to %s: affected rows: %s' % (cls.__table__, affected))
+        return affected
+
+    @classmethod
+    def _chunks(cls, args_list):
+        chunk = []
+        size = 0
+        for args in args_list:
+            # rough size of the row in the statement text
+            row_size = sum(len(str(arg)) + 4 for arg in args)
+            if chunk and (len(chunk) >= cls._max_rows or
+                          size + row_size > cls._max_packet):
+                yield chunk
+                chunk = []
+                size = 0
+            chunk.append(args)
+            size += row_size
+        if chunk:
+            yield chunk
+
+    def _insert_args(self):
         args = list(map(self.get_value, self.__fields__))
         if not self.__auto_increase__:
             args.append(self.get_value(self.__primary_key__))
+        return args
+
+    def _upsert_args(self):
+        args = list(map(self.get_value, self.__fields__))
+        args.append(self.get_value(self.__primary_key__))
+        return args
+
+    async def save(self):
+        args = self._insert_args()
         rows = await Model._sql.execute(self.__insert__, args)
         logging.debug('Insert record: affected rows: %s' % rows)
 
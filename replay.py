@@ -0,0 +1,226 @@
+"""Timelapse replay of ``pixel_history``.
+
+History is read in id order with keyset pagination, so replays hold no
+cursor and no more than ``chunk_size`` rows at a time. It is applied to a
+compact canvas buffer and cut into frames of ``step`` seconds of history
+time. Frames are written as PNG files or a GIF (Pillow), or pushed to the
+canvas websocket at N times real speed.
+
+    python replay.py --out replay.gif --step 60 --scale 4
+    python replay.py --out frames/ --format png
+"""
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+from array import array
+
+from orm import Model, Time
+from canvas import Canvas, Color, Pixel, encode_snapshot
+from websocket_sender import Message, MessageType
+
+
+class Frame:
+    __slots__ = ("index", "time", "changes", "keyframe")
+
+    def __init__(self, index, time, changes, keyframe=None):
+        self.index = index
+        self.time = time
+        # pos -> color id drawn during this frame
+        self.changes = changes
+        # copy of the whole buffer at the end of this frame, or None
+        self.keyframe = keyframe
+
+
+class Replay:
+    def __init__(self, col, row, step=60, keyframe_every=30, chunk_size=10000,
+                 skip_idle=True):
+        if not (math.isfinite(step) and step > 0):
+            raise ValueError(f"step must be a positive number, got {step}")
+        if keyframe_every < 1 or chunk_size < 1:
+            raise ValueError("keyframe_every and chunk_size must be positive")
+        self.col = col
+        self.row = row
+        self.buffer = array('H', bytes(2 * col * row))
+        self.step = step
+        self._keyframe_every = keyframe_every
+        self._chunk_size = chunk_size
+        self._skip_idle = skip_idle
+        self._last_time = None
+        self._last_timestamp = None
+
+    async def _history(self):
+        query = 'SELECT `id`, `pos`, `time`, `color_id` FROM `%s` WHERE `id` > ? ORDER BY `id` LIMIT %d' % (
+            Pixel.__table__, self._chunk_size)
+        last_id = 0
+        while True:
+            rows = await Model._sql.select(query, [last_id])
+            if not rows:
+                return
+            yield rows
+            last_id = rows[-1][0]
+
+    def _timestamp(self, time):
+        # history times repeat a lot, skip parsing the same one again
+        if time != self._last_time:
+            self._last_time = time
+            self._last_timestamp = Time.timestamp(time)
+        return self._last_timestamp
+
+    def _frame(self, index, time, changes):
+        keyframe = None
+        if index % self._keyframe_every == 0:
+            keyframe = array('H', self.buffer)
+        return Frame(index, time, changes, keyframe)
+
+    async def frames(self):
+        buffer = self.buffer
+        size = len(buffer)
+        step = self.step
+        changes = {}
+        frame_end = None
+        index = 0
+        async for rows in self._history():
+            for _, pos, time, color_id in rows:
+                timestamp = self._timestamp(time)
+                if frame_end is None:
+                    frame_end = timestamp + step
+                while timestamp >= frame_end:
+                    if changes or not self._skip_idle:
+                        yield self._frame(index, frame_end, changes)
+                        index += 1
+                        changes = {}
+                    if self._skip_idle:
+                        frame_end += step * ((timestamp - frame_end) // step + 1)
+                    else:
+                        frame_end += step
+                if 0 <= pos < size:
+                    buffer[pos] = color_id
+                    changes[pos] = color_id
+        if changes:
+            yield self._frame(index, frame_end, changes)
+
+
+def _palette(colors):
+    # palette index = color id, index 0 (empty) is white
+    if colors and max(colors) > 255:
+        raise ValueError(
+            f"Color id {max(colors)} does not fit an 8 bit image palette.")
+    palette = bytearray(b'\xff' * 768)
+    for color_id, hex_value in colors.items():
+        hex_value = hex_value.lstrip('#')
+        if len(hex_value) == 3:
+            hex_value = ''.join(c * 2 for c in hex_value)
+        palette[color_id * 3:color_id * 3 + 3] = bytes.fromhex(hex_value[:6])
+    return bytes(palette)
+
+
+def _image(buffer, col, palette, scale):
+    from PIL import Image
+    try:
+        pixels = array('B', buffer)
+    except OverflowError:
+        raise ValueError(
+            "pixel_history has color ids above 255, which do not fit an "
+            "8 bit image palette.") from None
+    image = Image.frombytes('P', (col, len(buffer) // col), pixels.tobytes())
+    image.putpalette(palette)
+    if scale > 1:
+        image = image.resize((image.width * scale, image.height * scale),
+                             Image.NEAREST)
+    return image
+
+
+async def render_png(replay, out_dir, colors, scale=1):
+    os.makedirs(out_dir, exist_ok=True)
+    palette = _palette(colors)
+    count = 0
+    async for frame in replay.frames():
+        _image(replay.buffer, replay.col, palette, scale).save(
+            os.path.join(out_dir, "frame_%06d.png" % frame.index))
+        count += 1
+    return count
+
+
+async def render_gif(replay, path, colors, scale=1, duration=100):
+    # Pillow keeps every GIF frame until save(), one byte per cell each
+    palette = _palette(colors)
+    images = []
+    async for frame in replay.frames():
+        images.append(_image(replay.buffer, replay.col, palette, scale))
+    if images:
+        images[0].save(path, save_all=True, append_images=images[1:],
+                       duration=duration, loop=0)
+    return len(images)
+
+
+def _send_keyframe(sender, replay, buffer, channel):
+    json_message = Message(MessageType.INIT_CANVAS, {
+        "col_num": replay.col, "row_num": replay.row, "colors": Color.colors,
+        "pixels": [color_id or None for color_id in buffer]})
+    return sender.send(encode_snapshot(replay.col, replay.row, Color.colors,
+                                       buffer), channel, json_message)
+
+
+async def broadcast(replay, sender, speed=60, channel="replay"):
+    """Plays the replay on the canvas websocket clients of ``channel``,
+    ``speed`` times faster than it was drawn, then sends them the live
+    canvas again. They get no live broadcasts meanwhile."""
+    if not (math.isfinite(speed) and speed > 0):
+        raise ValueError(f"speed must be a positive number, got {speed}")
+    delay = replay.step / speed
+    sender.hold(channel)
+    try:
+        await _send_keyframe(sender, replay,
+                             array('H', bytes(2 * len(replay.buffer))), channel)
+        async for frame in replay.frames():
+            await asyncio.sleep(delay)
+            if frame.keyframe is not None:
+                await _send_keyframe(sender, replay, frame.keyframe, channel)
+            else:
+                await sender.send(Message(MessageType.DRAW_PIXELS, {
+                    "pos": list(frame.changes),
+                    "colorid": list(frame.changes.values()),
+                    "username": [None] * len(frame.changes)
+                }), channel)
+    finally:
+        # queued before live broadcasts resume, which carry later versions
+        await sender.send(Canvas.snapshot(), channel, Canvas.canvas())
+        changes = Canvas.changes_message()
+        if changes is not None:
+            await sender.send(changes, channel)
+        sender.release(channel)
+
+
+async def _main(args, config):
+    from sql import SQL
+    SQL().connect(**config["database"])
+    await Color.init()
+    replay = Replay(config["canvas"]["col"], config["canvas"]["row"],
+                    step=args.step, chunk_size=args.chunk_size)
+    if args.format == "png":
+        count = await render_png(replay, args.out, Color.colors, args.scale)
+    else:
+        count = await render_gif(replay, args.out, Color.colors, args.scale,
+                                 args.duration)
+    print(f"{count} frames written to {args.out}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', default="./config.json")
+    parser.add_argument('--out', default="replay.gif")
+    parser.add_argument('--format', choices=("gif", "png"), default="gif")
+    parser.add_argument('--step', type=float, default=60,
+                        help="seconds of history per frame")
+    parser.add_argument('--scale', type=int, default=4)
+    parser.add_argument('--duration', type=int, default=100,
+                        help="milliseconds per GIF frame")
+    parser.add_argument('--chunk-size', type=int, default=10000)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    with open(args.config, "r") as json_file:
+        config = json.load(json_file)
+    asyncio.get_event_loop().run_until_complete(_main(args, config))
@@ -1,19 +1,26 @@
 import argparse
 import asyncio
 import logging
+import math
 import random
 import json
+import signal
 import time
+from urllib.parse import parse_qs, urlparse
 
 from sanic import Sanic
-from sanic.response import text
+from sanic.response import text, raw
 from sanic.response import json as sjson
 from sanic_token_auth import SanicTokenAuth
 
-from canvas import Canvas
-from live_handler import DanmakuClient, LiveHandler
+from canvas import Canvas, Color, Pixel
+from http_cache import HttpCache
+from metrics import Metrics
+import replay
+from live_handler import DanmakuClient, DanmakuPipeline, LiveHandler
 from music import Playlist, MusicService
 from sql import SQL
+from user import User
 from websocket_sender import WebsocketSender
 
 # Reading configurations from config.json
@@ -26,6 +33,10 @@ config_canvas = config["canvas"]
 config_messagews = config["messagews"]
 config_sanic = config["sanic"]
 config_initmessage = config["initmessage"]
+config_user = config.get("user", {})
+config_pipeline = config.get("pipeline", {})
+config_http_cache = config.get("http_cache", {})
+config_metrics = config.get("metrics", {})
 
 # Parse arguements
 parser = argparse.ArgumentParser()
@@ -54,8 +65,12 @@ logging.basicConfig(filename='./server.log', filemode='w', level=logging_level)
 
 # Connect to SQL
 sql = SQL()
-sql.connect(host=config_db["host"], port=config_db['port'], db=config_db["db"],
-            username=config_db["username"], password=config_db["password"])
+if config_db.get("backend", "mysql") == "mysql":
+    sql_init = []
+else:
+    # local databases are created on the fly
+    sql_init = [model.__create__ for model in (Pixel, Color, Canvas, User)]
+sql.connect(init=sql_init, **config_db)
 
 sanic_app = Sanic("danmaku_draw_game")
 
@@ -70,40 +85,139 @@ auth = SanicTokenAuth(sanic_app,
 
 print(f"SECRET KEY: {secret_key}")
 
+# Config metrics
+Metrics.config(enabled=config_metrics.get("enabled", False),
+               buckets=config_metrics.get("buckets"))
+
 # Config canvas
-Canvas.config(col=config_canvas["col"], row=config_canvas["row"])
+Canvas.config(col=config_canvas["col"], row=config_canvas["row"],
+              batch_size=config_canvas.get("batch_size", 500),
+              flush_interval=config_canvas.get("flush_interval", 1),
+              max_pending=config_canvas.get("max_pending", 20000),
+              cooldown=config_canvas.get("cooldown", 3),
+              vip_cooldown=config_canvas.get("vip_cooldown"),
+              colors=config_canvas.get("colors"),
+              checkpoint_path=config_canvas.get("checkpoint_path"),
+              checkpoint_interval=config_canvas.get("checkpoint_interval", 60),
+              checkpoint_verify=config_canvas.get("checkpoint_verify", False),
+              tile_size=config_canvas.get("tile_size", 16),
+              history_size=config_canvas.get("history_size", 10000))
+
+# Config user cache
+User.config(cache_size=config_user.get("cache_size", 5000),
+            cache_ttl=config_user.get("cache_ttl", 300),
+            flush_interval=config_user.get("flush_interval", 5))
+User.start()
 
 # Config music
 music_service = MusicService(config_music["port"],
                              config_music["ip"],
-                             config_music["cookie"])
+                             config_music["cookie"],
+                             timeout=config_music.get("timeout", 10),
+                             retries=config_music.get("retries", 2),
+                             **config_music.get("cache", {}))
 Playlist.set_serivce(music_service)
+Playlist.config_limits(total_limit=config_music.get("total_limit", 100),
+                       limit_per_user=config_music.get("limit_per_user", 3))
+Playlist.config_prefetch(count=config_music.get("prefetch", 3),
+                         ttl=config_music.get("prefetch_ttl", 300))
 if "default" in config_music:
     for query in config_music["default"]:
         Playlist.add_to_default(query)
 
 message_sender = WebsocketSender(config_messagews["port"],
-                                 config_messagews["ip"],)
+                                 config_messagews["ip"],
+                                 slow_policy="drop")
+
+
+# New canvas clients get a binary snapshot, or JSON with ?format=json
+def _int_arg(args, name):
+    try:
+        return int(args[name][0])
+    except (KeyError, ValueError):
+        return None
+
+
+def canvas_on_connect(path):
+    args = parse_qs(urlparse(path).query)
+    # reconnecting clients pass the last version they saw
+    since = _int_arg(args, "since")
+    if since is not None:
+        changes = Canvas.changes_message(since, _int_arg(args, "epoch"))
+        if changes is not None:
+            return changes
+    if args.get("format") == ["json"]:
+        return Canvas.canvas()
+    changes = Canvas.changes_message()
+    if changes is None:
+        # still hydrating, there is no version to resume from yet
+        return Canvas.snapshot()
+    return [Canvas.snapshot(), changes]
+
+
 canvas_sender = WebsocketSender(config_canvas["port"],
-                                config_canvas["ip"],)
+                                config_canvas["ip"],
+                                on_connect=canvas_on_connect)
+
+
+async def playlist_changed():
+    await message_sender.send(await Playlist.playlist())
+
+Playlist.set_on_change(playlist_changed)
 
 live_handler = LiveHandler(message_sender=message_sender,
                            canvas_sender=canvas_sender,
-                           init_message=config_initmessage)
+                           init_message=config_initmessage,
+                           draw_tick=config_canvas.get("broadcast_tick", 0) / 1000,
+                           pipeline=DanmakuPipeline(**config_pipeline))
 
 client = DanmakuClient(config_live["id"], handler=live_handler,
                        logger=live_room_logger)
 
+Metrics.gauge("websocket_clients", lambda: {
+    (("sender", sender.name()),): sender.client_count()
+    for sender in (message_sender, canvas_sender)})
+Metrics.gauge("danmaku_pending", lambda: live_handler.pipeline_stats()["depth"])
+Metrics.gauge("user_cache_size", lambda: User.cache_stats()["size"])
+Metrics.gauge("user_dirty", lambda: User.cache_stats()["dirty"])
+Metrics.gauge("canvas_version", Canvas.version)
+
+
+http_cache = HttpCache(**config_http_cache)
+
+
+def message_response(message):
+    return raw(message.encode(), content_type="application/json")
+
+
+async def cached_response(request, key, version, build, content_type,
+                          headers=None):
+    status, body, headers = await http_cache.respond(
+        request.headers, key, version, build, headers)
+    return raw(body, status=status, headers=headers, content_type=content_type)
+
+
+@sanic_app.get("/api/metrics")
+@auth.auth_required
+async def get_metrics(request):
+    return text(Metrics.render(),
+                content_type="text/plain; version=0.0.4; charset=utf-8")
+
 
 @sanic_app.get("/api/message/hints")
 async def get_hints(request):
-    return sjson(live_handler.get_init_message().to_json())
+    return message_response(live_handler.get_init_message())
+
+
+async def build_playlist():
+    return (await Playlist.playlist()).encode()
 
 
 @sanic_app.get("/api/music/playlist")
 @auth.auth_required
 async def get_playlist(request):
-    return sjson((await Playlist.playlist()).to_json())
+    return await cached_response(request, "playlist", Playlist.version(),
+                                 build_playlist, "application/json")
 
 
 @sanic_app.get("/api/music/playlist/default")
@@ -119,7 +233,7 @@ async def music_detail(request):
     if not succeed:
         await Playlist.skip()
         await message_sender.send(await Playlist.playlist())
-    return sjson(play_message.to_json())
+    return message_response(play_message)
 
 
 @sanic_app.get("/api/music/skip")
@@ -127,7 +241,7 @@ async def music_detail(request):
 async def skip_song(request):
     await Playlist.skip()
     await message_sender.send(await Playlist.playlist())
-    return sjson((await Playlist.playlist()).to_json())
+    return message_response(await Playlist.playlist())
 
 
 @sanic_app.post("/api/music/add")
@@ -139,9 +253,76 @@ async def add_default_song(request):
     return text("Error")
 
 
+async def build_canvas_json():
+    return Canvas.canvas().encode()
+
+
+async def build_canvas_snapshot():
+    return Canvas.snapshot()
+
+
 @sanic_app.get("/api/canvas/canvas")
 async def get_canvas(request):
-    return sjson(Canvas.canvas().to_json())
+    version = (Canvas.epoch(), Canvas.version())
+    headers = {"X-Canvas-Version": str(Canvas.version()),
+               "X-Canvas-Epoch": str(Canvas.epoch())}
+    if request.args.get("format") == "json":
+        key, build, content_type = "canvas-json", build_canvas_json, \
+            "application/json"
+    else:
+        key, build, content_type = "canvas", build_canvas_snapshot, \
+            "application/octet-stream"
+    if not Canvas.ready():
+        # still hydrating: neither memoize nor validate a partial canvas
+        headers["Cache-Control"] = "no-store"
+        return raw(await build(), headers=headers, content_type=content_type)
+    return await cached_response(request, key, version, build, content_type,
+                                 headers)
+
+
+@sanic_app.get("/api/canvas/changes")
+async def get_canvas_changes(request):
+    try:
+        since = int(request.args.get("since"))
+        epoch = int(request.args.get("epoch"))
+    except (TypeError, ValueError):
+        return text("Error")
+    changes = Canvas.changes(since, epoch)
+    if changes is None:
+        # aged out of the ring: fetch /api/canvas/canvas again
+        changes = {"version": Canvas.version(), "epoch": Canvas.epoch(),
+                   "mode": "snapshot"}
+    return sjson(changes)
+
+
+replay_task = None
+
+
+def replay_done(task):
+    if not task.cancelled() and task.exception() is not None:
+        logging.error("Canvas replay failed.", exc_info=task.exception())
+
+
+@sanic_app.post("/api/canvas/replay")
+@auth.auth_required
+async def replay_canvas(request):
+    global replay_task
+    if replay_task is not None and not replay_task.done():
+        return text("Error")
+    options = request.json or {}
+    try:
+        speed = float(options.get("speed", 60))
+        if not (math.isfinite(speed) and speed > 0):
+            raise ValueError
+        canvas_replay = replay.Replay(config_canvas["col"], config_canvas["row"],
+                                      step=float(options.get("step", 60)))
+    except (TypeError, ValueError):
+        return text("Error")
+    replay_task = asyncio.get_event_loop().create_task(
+        replay.broadcast(canvas_replay, canvas_sender, speed))
+    replay_task.add_done_callback(replay_done)
+    return text("OK")
+
 
 @sanic_app.post("/api/user/changeweight")
 @auth.auth_required
@@ -161,5 +342,22 @@ server = sanic_app.create_server(access_log=False,
                                  host=config_sanic["ip"],
                                  port=config_sanic["port"],
                                  return_asyncio_server=True)
-asyncio.get_event_loop().create_task(server)
-asyncio.get_event_loop().run_forever()
+
+async def shutdown():
+    await live_handler.close()
+    await Canvas.close()
+    await User.close()
+    await music_service.close()
+
+loop = asyncio.get_event_loop()
+try:
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+except NotImplementedError:
+    pass
+loop.create_task(server)
+try:
+    loop.run_forever()
+except KeyboardInterrupt:
+    pass
+finally:
+    loop.run_until_complete(shutdown())
@@ -1,8 +1,58 @@
 from orm import Model, StringField, IntegerField
+from collections import OrderedDict
+import asyncio
 import logging
+import time
+
 
 class User(Model):
 
+    # uid -> (user, loaded at), least recently used first
+    _cache = OrderedDict()
+    # uid -> user, users waiting to be written back
+    _dirty = {}
+    # uid -> user, users in the write that is in flight
+    _flushing = {}
+    _loading = {}
+    _cache_size = 5000
+    _cache_ttl = 300
+    _flush_interval = 5
+    _flush_task = None
+    _flush_lock = None
+    _hits = 0
+    _misses = 0
+
+    @classmethod
+    def config(cls, cache_size=5000, cache_ttl=300, flush_interval=5):
+        cls._cache_size = cache_size
+        cls._cache_ttl = cache_ttl
+        cls._flush_interval = flush_interval
+
+    @classmethod
+    def start(cls):
+        if cls._flush_task is None:
+            cls._flush_task = asyncio.get_event_loop().create_task(
+                cls._flush_loop())
+
+    @classmethod
+    async def close(cls):
+        if cls._flush_task is not None:
+            # a write in flight finishes first, cancelling it would lose
+            # the users taken out of _dirty for it
+            async with cls._lock():
+                cls._flush_task.cancel()
+                try:
+                    await cls._flush_task
+                except asyncio.CancelledError:
+                    pass
+            cls._flush_task = None
+        await cls.flush()
+
+    @classmethod
+    def cache_stats(cls):
+        return {"hits": cls._hits, "misses": cls._misses,
+                "size": len(cls._cache), "dirty": len(cls._dirty)}
+
     @classmethod
     async def find(cls, primary_key):
         user = await super(User, cls).find(primary_key)
@@ -14,18 +64,148 @@ class User(Model):
 
     @classmethod
     async def user(cls, **kw):
-        user = await cls.find(kw["uid"])
-        if not user:
-            user = User(**kw)
-            uid = kw["uid"]
-            logging.debug(f"New user {uid} created.")
-        elif "name" in kw and kw["name"] != user.name:
+        # API callers may pass the uid as a string, the cache is keyed by int
+        uid = kw["uid"] = cls._uid(kw["uid"])
+        user = cls._cached(uid)
+        if user is None:
+            cls._misses += 1
+            user = await cls._load(uid)
+            if not user:
+                if kw.get("name") is None:
+                    raise ValueError(f"Unknown user {uid} has no name.")
+                user = User(**kw)
+                logging.debug(f"New user {uid} created.")
+            cls._remember(user)
+        else:
+            cls._hits += 1
+        if "name" in kw and kw["name"] != user.name:
             user.name = kw["name"]
         return user
 
+    @staticmethod
+    def _uid(uid):
+        if isinstance(uid, bool) or not isinstance(uid, (int, str)):
+            raise ValueError(f"Invalid uid {uid!r}.")
+        return int(uid)
+
+    @classmethod
+    def _cached(cls, uid):
+        entry = cls._cache.get(uid)
+        if entry is None:
+            return None
+        user, loaded_at = entry
+        now = time.monotonic()
+        if now - loaded_at > cls._cache_ttl and not cls._pinned(uid):
+            del cls._cache[uid]
+            return None
+        cls._cache[uid] = (user, now)
+        cls._cache.move_to_end(uid)
+        return user
+
+    @classmethod
+    def _pinned(cls, uid):
+        # the DB row of these users is older than the cached object
+        return uid in cls._dirty or uid in cls._flushing
+
+    @classmethod
+    async def _load(cls, uid):
+        # concurrent lookups of the same uid share one query
+        loading = cls._loading.get(uid)
+        if loading is not None:
+            return await loading
+        loading = asyncio.get_event_loop().create_future()
+        cls._loading[uid] = loading
+        try:
+            user = await cls.find(uid)
+            loading.set_result(user)
+        except Exception as e:
+            loading.set_exception(e)
+            raise
+        finally:
+            del cls._loading[uid]
+        return user
+
+    @classmethod
+    def _remember(cls, user):
+        cls._cache[user.uid] = (user, time.monotonic())
+        cls._cache.move_to_end(user.uid)
+        # dirty users stay cached until they are written back
+        checked = 0
+        while len(cls._cache) > cls._cache_size and checked < len(cls._cache):
+            uid = next(iter(cls._cache))
+            if cls._pinned(uid):
+                cls._cache.move_to_end(uid)
+            else:
+                del cls._cache[uid]
+            checked += 1
+
+    @classmethod
+    def _mark_dirty(cls, user):
+        if cls._dirty.get(user.uid) is not user:
+            cls._dirty[user.uid] = user
+            cached = cls._cache.get(user.uid)
+            if cached is None or cached[0] is not user:
+                cls._remember(user)
+
+    @classmethod
+    async def _flush_loop(cls):
+        while True:
+            await asyncio.sleep(cls._flush_interval)
+            try:
+                await cls.flush()
+            except Exception:
+                logging.exception("User flush failed.")
+
+    @classmethod
+    def _lock(cls):
+        if cls._flush_lock is None:
+            cls._flush_lock = asyncio.Lock()
+        return cls._flush_lock
+
+    @classmethod
+    async def flush(cls):
+        # one write at a time, so an older batch never lands after a newer one
+        async with cls._lock():
+            await cls._flush()
+
+    @classmethod
+    async def _flush(cls):
+        if not cls._dirty:
+            return
+        dirty = cls._dirty
+        cls._dirty = {}
+        cls._flushing.update(dirty)
+        users = list(dirty.values())
+        try:
+            try:
+                await cls.upsert_many(users)
+            except Exception:
+                logging.exception(
+                    f"Writing {len(users)} users failed, retrying one by one.")
+                await cls._flush_each(users)
+        finally:
+            for uid, user in dirty.items():
+                if cls._flushing.get(uid) is user:
+                    del cls._flushing[uid]
+        logging.debug(f"Flushed {len(users)} users to DB.")
+
+    @classmethod
+    async def _flush_each(cls, users):
+        # one bad row must not keep the rest of the batch from being written
+        for user in users:
+            try:
+                await cls.upsert_many([user])
+            except Exception:
+                logging.exception(f"Dropped changes of user {user.uid}.")
+
     async def save(self):
-        logging.debug(f"User {self.uid} saved to DB.")
-        await super().save_or_update()
+        User._mark_dirty(self)
+        logging.debug(f"User {self.uid} marked for saving.")
+
+    def __setattr__(self, key, value):
+        if key in self.__mappings__ and getattr(self, key, None) != value:
+            User._mark_dirty(self)
+        super().__setattr__(key, value)
 
     __table__ = "user"
 
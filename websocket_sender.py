@@ -1,11 +1,21 @@
 import asyncio
 import websockets
-import threading
 import json
+import struct
+import sys
+from array import array
 from enum import Enum, unique
+from urllib.parse import parse_qs, urlparse
 
 import logging
 
+from metrics import Metrics
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 @unique
 class MessageType(Enum):
     DRAW_PIXEL = 0
@@ -18,12 +28,102 @@ class MessageType(Enum):
     INIT_MESSAGE = 7
     RECEIVE_GIFT = 8
     DRAW_MULTIPLE_PIXELS = 9
+    DRAW_PIXELS = 10
+    CANVAS_CHANGES = 11
+
+
+def _json_dumps(obj):
+    return json.dumps(obj, ensure_ascii=False,
+                      separators=(',', ':')).encode('utf-8')
+
+
+def _orjson_dumps(obj):
+    # color palettes are keyed by int color ids
+    return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+
+# Binary draw frame, for clients connected with ?frames=binary:
+#   header <4sBBBQI   magic, format version, message type, flags,
+#                     canvas version, pixel count
+#   body   positions  <H or <I (FRAME_SHORT_POS) * count
+#          color ids  <H * count, or once (FRAME_ONE_COLOR)
+#          names      <H name count + (<B length + utf-8 name) per name
+#          name index <H * count, or once (FRAME_ONE_NAME); 0xFFFF = no name
+DRAW_FRAME_MAGIC = b"DDPX"
+DRAW_FRAME_VERSION = 1
+FRAME_SHORT_POS = 1
+FRAME_ONE_COLOR = 2
+FRAME_ONE_NAME = 4
+_DRAW_FRAME_HEADER = struct.Struct('<4sBBBQI')
+_NO_NAME = 0xFFFF
+
+
+def encode_draw_frame(message_type, data):
+    flags = 0
+    positions = data["pos"]
+    if not isinstance(positions, list):
+        positions = [positions]
+    count = len(positions)
+    if not positions or max(positions) <= 0xFFFF:
+        flags |= FRAME_SHORT_POS
+        positions = array('H', positions)
+    else:
+        positions = array('I', positions)
+    color_ids = data["colorid"]
+    if isinstance(color_ids, list):
+        color_ids = array('H', color_ids)
+    else:
+        flags |= FRAME_ONE_COLOR
+        color_ids = array('H', [color_ids])
+    usernames = data.get("username")
+    if not isinstance(usernames, list):
+        flags |= FRAME_ONE_NAME
+        usernames = [usernames]
+    names = {}
+    name_indexes = array('H', [
+        _NO_NAME if name is None else names.setdefault(name, len(names))
+        for name in usernames])
+    if sys.byteorder == 'big':
+        for part in (positions, color_ids, name_indexes):
+            part.byteswap()
+
+    frame = bytearray(_DRAW_FRAME_HEADER.pack(
+        DRAW_FRAME_MAGIC, DRAW_FRAME_VERSION, message_type.value, flags,
+        data.get("version") or 0, count))
+    frame += positions.tobytes()
+    frame += color_ids.tobytes()
+    frame += struct.pack('<H', len(names))
+    for name in names:
+        name_bytes = name.encode('utf-8')[:255]
+        frame += struct.pack('<B', len(name_bytes)) + name_bytes
+    frame += name_indexes.tobytes()
+    return bytes(frame)
+
+
+_BINARY_TYPES = frozenset((MessageType.DRAW_PIXEL,
+                           MessageType.DRAW_MULTIPLE_PIXELS,
+                           MessageType.DRAW_PIXELS))
 
 
 class Message:
+    """A typed websocket / HTTP message. Encodings are made on first use
+    and cached, so ``data`` must not change once the message is sent."""
+
+    __slots__ = ("_type", "_data", "_encoded", "_text", "_binary")
+
+    _dumps = staticmethod(_orjson_dumps if orjson else _json_dumps)
+
     def __init__(self, message_type: MessageType, data):
         self._type = message_type
         self._data = data
+        self._encoded = None
+        self._text = None
+        self._binary = None
+
+    @classmethod
+    def set_encoder(cls, dumps):
+        """Sets the JSON encoder, a function returning UTF-8 bytes."""
+        cls._dumps = staticmethod(dumps)
 
     @classmethod
     def none(cls):
@@ -32,60 +132,242 @@ class Message:
     def to_json(self):
         return {"type": self._type.name, "data": self._data}
 
+    def encode(self):
+        if self._encoded is None:
+            self._encoded = Message._dumps(self.to_json())
+        return self._encoded
+
+    def to_binary(self):
+        """Returns the binary draw frame, or None for other types."""
+        if self._type not in _BINARY_TYPES:
+            return None
+        if self._binary is None:
+            self._binary = encode_draw_frame(self._type, self._data)
+        return self._binary
+
     def __str__(self):
-        return json.dumps(self.to_json())
+        if self._text is None:
+            self._text = self.encode().decode('utf-8')
+        return self._text
 
 class WebsocketSender:
-    def __init__(self, port, ip = 'localhost'):
+    """Broadcast hub with one bounded outbound queue per client.
+
+    Every client has its own sender task, so a slow socket only delays
+    itself. When a client's queue is full, ``slow_policy`` decides what
+    happens: ``"drop"`` discards the client's oldest queued message and
+    ``"disconnect"`` closes the client so that it reconnects and resyncs.
+
+    Clients connected with ``?channel=<name>`` also get the messages sent
+    to that channel. While a channel is held they get nothing else.
+    """
+
+    def __init__(self, port, ip = 'localhost', on_connect=None,
+                 queue_size=256, slow_policy="disconnect"):
         self._port = port
         self._ip = ip
         self._name = str(ip) + ':' + str(port)
+        self._labels = (("sender", self._name),)
         self._loop = asyncio.get_event_loop()
-        self._future = self._loop.create_future()
-        self._future_lock = False
-        self._clients = set()
-        self._messagequeue = []
+        self._clients = {}
+        # clients that asked for binary draw frames
+        self._binary_clients = set()
+        # clients that asked for JSON only, with ?format=json
+        self._json_clients = set()
+        # websocket -> channel it subscribed to
+        self._channels = {}
+        self._held = set()
+        self._on_connect = on_connect
+        self._queue_size = queue_size
+        self._slow_policy = slow_policy
         self._start()
     
-    # start a new thread to handle websocket
     def _start(self):
-        asyncio.get_event_loop().run_until_complete(websockets.serve(self._connect, self._ip, self._port))
-        # asyncio.ensure_future(websockets.serve(self._connect, self._ip, self._port))
+        self._loop.run_until_complete(websockets.serve(self._connect, self._ip, self._port))
 
     async def _connect(self, websocket, path):
-        self._clients.add(websocket)
-        logging.debug(f"New websocket connection to {self._name}")
-        while True:
-            # self._future_lock.set_result(True)
-            if len(self._messagequeue) == 0:
-                self._future_lock = self._loop.create_future()
-                await self._future_lock
-
-            # message = await self._future
-            message = self._messagequeue.pop(0)
-            # self._future = self._loop.create_future()
-            count = 0
-
-            # send message to all connected clients
-            for ws in list(self._clients):
-                try:
-                    await ws.send(str(message))
-                    count += 1
-                except websockets.exceptions.ConnectionClosed:
-                    self._clients.remove(ws)
-                except TypeError:
-                    pass
-            logging.debug(f"Websocket {self._name} sent message \"{str(message)}\" to {count} clients.")
-
-    async def send(self, message:Message):
-        self._messagequeue.append(message)
-
-        if not self._future_lock.done():
-            self._future_lock.set_result(True)
-        # await self._future_lock
-        # self._future.set_result(message)
-        # self._future_lock = self._loop.create_future()
-        
-
-
-        
+        # registered before the initial payloads are made, so broadcasts
+        # sent meanwhile queue up behind them instead of being lost
+        queue = asyncio.Queue(self._queue_size)
+        self._clients[websocket] = queue
+        query = parse_qs(urlparse(path).query)
+        if query.get("frames") == ["binary"]:
+            self._binary_clients.add(websocket)
+        if query.get("format") == ["json"]:
+            self._json_clients.add(websocket)
+        if "channel" in query:
+            self._channels[websocket] = query["channel"][0]
+        sender = None
+        try:
+            initial = []
+            if self._on_connect is not None:
+                # initial payloads, Messages or already encoded frames
+                payloads = self._on_connect(path)
+                if not isinstance(payloads, (list, tuple)):
+                    payloads = [payloads]
+                initial = [str(payload) if isinstance(payload, Message)
+                           else payload
+                           for payload in payloads if payload is not None]
+            logging.debug(f"New websocket connection to {self._name}")
+            sender = self._loop.create_task(
+                self._send_loop(websocket, queue, initial))
+            await websocket.wait_closed()
+        finally:
+            if sender is not None:
+                sender.cancel()
+            self._forget(websocket)
+            logging.debug(f"Websocket connection to {self._name} closed")
+
+    async def _send_loop(self, websocket, queue, initial=()):
+        try:
+            for payload in initial:
+                await websocket.send(payload)
+            while True:
+                await websocket.send(await queue.get())
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        except Exception:
+            logging.exception(f"Websocket {self._name} failed to send to a client.")
+        # the loop stopped by itself: a client left registered would only
+        # fill its queue, so close it and let it reconnect
+        self._forget(websocket)
+        self._loop.create_task(websocket.close())
+
+    def _forget(self, websocket):
+        self._clients.pop(websocket, None)
+        self._binary_clients.discard(websocket)
+        self._json_clients.discard(websocket)
+        self._channels.pop(websocket, None)
+
+    def _on_slow(self, websocket, queue, payload):
+        if self._slow_policy == "drop":
+            queue.get_nowait()
+            queue.put_nowait(payload)
+            Metrics.inc("websocket_slow_total", self._labels + (("action", "drop"),))
+            logging.debug(f"Websocket {self._name} dropped a message for a slow client.")
+        else:
+            self._forget(websocket)
+            self._loop.create_task(websocket.close())
+            Metrics.inc("websocket_slow_total", self._labels + (("action", "disconnect"),))
+            logging.warning(f"Websocket {self._name} disconnected a slow client.")
+
+    def name(self):
+        return self._name
+
+    def client_count(self):
+        return len(self._clients)
+
+    def hold(self, channel):
+        """Stops broadcasts to the clients of ``channel`` until released."""
+        self._held.add(channel)
+
+    def release(self, channel):
+        self._held.discard(channel)
+
+    async def send(self, message:Message, channel=None, json_message=None):
+        """Queues ``message`` for every client, or only for the clients of
+        ``channel``. JSON clients cannot read ``bytes`` messages, they get
+        ``json_message`` instead, or nothing."""
+        with Metrics.timer("websocket_send_seconds", self._labels):
+            count = self._send(message, channel, json_message)
+        Metrics.inc("websocket_messages_total", self._labels, count)
+        logging.debug(f"Websocket {self._name} queued a message for {count} clients.")
+
+    def _send(self, message, channel=None, json_message=None):
+        # serialized once, shared by every client queue; bytes go out as is
+        if isinstance(message, bytes):
+            payload = binary = message
+            text = None
+            if json_message is not None and self._json_clients:
+                text = str(json_message)
+        else:
+            payload = text = str(message)
+            binary = None
+            if self._binary_clients:
+                binary = message.to_binary()
+            if binary is None:
+                binary = payload
+        binary_clients = self._binary_clients
+        json_clients = self._json_clients
+        channels = self._channels
+        held = self._held
+        count = 0
+        for websocket, queue in list(self._clients.items()):
+            client_channel = channels.get(websocket)
+            if channel is None and client_channel in held:
+                continue
+            if channel is not None and client_channel != channel:
+                continue
+            if websocket in json_clients:
+                client_payload = text
+            elif websocket in binary_clients:
+                client_payload = binary
+            else:
+                client_payload = payload
+            if client_payload is None:
+                continue
+            count += 1
+            try:
+                queue.put_nowait(client_payload)
+            except asyncio.QueueFull:
+                self._on_slow(websocket, queue, client_payload)
+        return count
+
+
+class DrawCoalescer:
+    """Collects pixel draws for ``tick`` seconds and broadcasts them as one
+    ``DRAW_PIXELS`` message. Only the last write to a position is kept.
+    Messages carry the highest canvas version of the draws they contain."""
+
+    def __init__(self, sender, tick=0.05):
+        self._sender = sender
+        self._tick = tick
+        self._pixels = {}
+        self._version = None
+        self._task = None
+
+    def add(self, pos, color_id, username=None, version=None):
+        # re-insert so the message keeps the order of the last writes
+        self._pixels.pop(pos, None)
+        self._pixels[pos] = (color_id, username)
+        self._add_version(version)
+        self._schedule()
+
+    def add_many(self, positions, color_id, username=None, version=None):
+        pixels = self._pixels
+        for pos in positions:
+            pixels.pop(pos, None)
+            pixels[pos] = (color_id, username)
+        self._add_version(version)
+        self._schedule()
+
+    def _add_version(self, version):
+        if version is not None and (self._version is None
+                                    or version > self._version):
+            self._version = version
+
+    def _schedule(self):
+        if self._task is None:
+            self._task = asyncio.get_event_loop().create_task(
+                self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self._tick)
+        self._task = None
+        await self.flush()
+
+    async def flush(self):
+        if not self._pixels:
+            return
+        pixels = self._pixels
+        version = self._version
+        self._pixels = {}
+        self._version = None
+        data = {
+            "pos": list(pixels),
+            "colorid": [color_id for color_id, _ in pixels.values()],
+            "username": [username for _, username in pixels.values()]
+        }
+        if version is not None:
+            data["version"] = version
+        await self._sender.send(Message(MessageType.DRAW_PIXELS, data))